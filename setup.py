@@ -53,7 +53,7 @@ setup(
 
     install_requires=[
         'numpy',
-        'opencv-contrib-python-headless',
+        'opencv-contrib-python-headless>=4.7',
         'imshowTk',
         'scikit-surgerycore>=0.6.9'
     ],
@@ -61,6 +61,7 @@ setup(
     entry_points={
         'console_scripts': [
             'scikit-surgeryarucotracker=sksurgeryarucotracker.__main__:main',
+            'sksurgeryarucotracker-autotune=sksurgeryarucotracker.autotune:main',
         ],
     },
 )
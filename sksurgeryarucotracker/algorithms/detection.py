@@ -0,0 +1,983 @@
+""" Classes and functions for detecting ArUco markers in images """
+
+import numpy
+import cv2
+from cv2 import aruco
+
+
+def _grey(frame):
+    """
+    :return: a greyscale version of frame
+    """
+    if frame.ndim == 3:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame
+
+
+def _grey_copy(frame):
+    """
+    :return: a greyscale version of frame that does not share memory
+        with it, so can be kept after the frame's buffer is reused
+    """
+    if frame.ndim == 3:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame.copy()
+
+
+#named sets of aruco detector parameters. balanced is OpenCV's default,
+#fast uses a single adaptive threshold window rather than three, and
+#accurate uses more windows and refines corners to sub-pixel accuracy
+DETECTOR_PRESETS = {
+    'fast' : {'adaptiveThreshWinSizeMin' : 13,
+              'adaptiveThreshWinSizeMax' : 13,
+              'adaptiveThreshWinSizeStep' : 10,
+              'cornerRefinementMethod' : aruco.CORNER_REFINE_NONE},
+    'balanced' : {'adaptiveThreshWinSizeMin' : 3,
+                  'adaptiveThreshWinSizeMax' : 23,
+                  'adaptiveThreshWinSizeStep' : 10,
+                  'cornerRefinementMethod' : aruco.CORNER_REFINE_NONE},
+    'accurate' : {'adaptiveThreshWinSizeMin' : 3,
+                  'adaptiveThreshWinSizeMax' : 23,
+                  'adaptiveThreshWinSizeStep' : 4,
+                  'cornerRefinementMethod' : aruco.CORNER_REFINE_SUBPIX}
+}
+
+
+def detector_parameters(preset = None, parameters = None):
+    """
+    Makes aruco detector parameters from a named preset, with any
+    individual parameters set on top.
+
+    :param preset: None for OpenCV's defaults, or one of the names in
+        DETECTOR_PRESETS
+    :param parameters: a dictionary of aruco.DetectorParameters
+        attribute names and values. cornerRefinementMethod may be given
+        by name, e.g. CORNER_REFINE_SUBPIX
+    :return: aruco detector parameters
+    :raise ValueError: if the preset or a parameter name is unknown
+    """
+    values = {}
+    if preset is not None:
+        if preset not in DETECTOR_PRESETS:
+            raise ValueError(f'Unknown detector preset {preset}, should be '
+                             f'one of {list(DETECTOR_PRESETS)}')
+        values.update(DETECTOR_PRESETS[preset])
+    if parameters is not None:
+        values.update(parameters)
+
+    detector_params = aruco.DetectorParameters()
+    for name, value in values.items():
+        if name.startswith('_') or not hasattr(detector_params, name):
+            raise ValueError(f'Unknown detector parameter {name}')
+        if name == 'cornerRefinementMethod' and isinstance(value, str):
+            value = getattr(aruco, value)
+        setattr(detector_params, name, value)
+    return detector_params
+
+
+def copy_parameters(parameters):
+    """
+    :param parameters: aruco detector parameters
+    :return: a copy of the parameters
+    """
+    copied = aruco.DetectorParameters()
+    for name in dir(parameters):
+        if not name.startswith('_') and \
+                not callable(getattr(parameters, name)):
+            setattr(copied, name, getattr(parameters, name))
+    return copied
+
+
+def _extract_bits(grey, corners, dictionary, parameters):
+    """
+    Samples the bits of a candidate marker, following the method used
+    internally by OpenCV's ArUco detector.
+
+    :param grey: the greyscale image
+    :param corners: 4x2 array of candidate corners, clockwise
+    :param dictionary: the aruco dictionary, used for the marker size
+    :param parameters: aruco detector parameters
+    :return: a square array of bits, including the border bits
+    """
+    border_bits = parameters.markerBorderBits
+    cells = dictionary.markerSize + 2 * border_bits
+    cell_size = parameters.perspectiveRemovePixelPerCell
+    cell_margin = int(parameters.perspectiveRemoveIgnoredMarginPerCell *
+                      cell_size)
+    image_size = cells * cell_size
+    target = numpy.array([[0, 0], [image_size - 1, 0],
+                          [image_size - 1, image_size - 1],
+                          [0, image_size - 1]], dtype = numpy.float32)
+    transform = cv2.getPerspectiveTransform(
+                    corners.astype(numpy.float32), target)
+    warped = cv2.warpPerspective(grey, transform, (image_size, image_size),
+                                 flags = cv2.INTER_NEAREST)
+
+    half_cell = int(cell_size / 2)
+    inner = warped[half_cell:image_size - half_cell,
+                   half_cell:image_size - half_cell]
+    if numpy.std(inner) < parameters.minOtsuStdDev:
+        value = 1 if numpy.mean(inner) > 127 else 0
+        return numpy.full((cells, cells), value, dtype = numpy.uint8)
+
+    _, warped = cv2.threshold(warped, 125, 255,
+                              cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    inner_size = cell_size - 2 * cell_margin
+    warped = warped.reshape(cells, cell_size, cells, cell_size)
+    sampled = warped[:, cell_margin:cell_margin + inner_size,
+                     :, cell_margin:cell_margin + inner_size]
+    non_zero = numpy.count_nonzero(sampled, axis = (1, 3))
+    return (non_zero > (inner_size * inner_size) / 2).astype(numpy.uint8)
+
+
+def identify_candidates(grey, candidates, dictionary, parameters):
+    """
+    Identifies candidate marker quads against a dictionary, without
+    repeating the thresholding and contour finding stage of detection.
+
+    :param grey: the greyscale image
+    :param candidates: a list of 1x4x2 candidate corner arrays, clockwise
+    :param dictionary: the aruco dictionary to identify against
+    :param parameters: aruco detector parameters
+    :return: marker corners and marker ids, in the format returned by
+        aruco.detectMarkers
+    """
+    border_bits = parameters.markerBorderBits
+    marker_size = dictionary.markerSize
+    max_border_errors = int(marker_size * marker_size *
+                            parameters.maxErroneousBitsInBorderRate)
+    marker_corners = []
+    marker_ids = []
+    for candidate in candidates:
+        corners = candidate.reshape(4, 2)
+        bits = _extract_bits(grey, corners, dictionary, parameters)
+        border = numpy.ones(bits.shape, dtype = bool)
+        border[border_bits:-border_bits, border_bits:-border_bits] = False
+        if numpy.count_nonzero(bits[border]) > max_border_errors:
+            continue
+
+        only_bits = bits[border_bits:-border_bits, border_bits:-border_bits]
+        found, marker_id, rotation = dictionary.identify(
+                        only_bits, parameters.errorCorrectionRate)
+        if not found:
+            continue
+
+        corners = numpy.roll(corners, rotation, axis = 0)
+        marker_corners.append(corners.reshape(1, 4, 2))
+        marker_ids.append([marker_id])
+
+    if not marker_ids:
+        return (), None
+    return tuple(marker_corners), numpy.array(marker_ids, dtype = numpy.int32)
+
+
+def undistort_detections(detections, camera_projection_matrix,
+                camera_distortion):
+    """
+    Removes lens distortion from the corners of all detected markers
+    with a single call to cv2.undistortPoints. The corners stay in
+    pixel coordinates, so can be used for pose estimation with the
+    same camera projection matrix and zero distortion.
+
+    :param detections: a list of marker corners and marker ids, as
+        returned by MarkerDetector.detect
+    :param camera_projection_matrix: a 3x3 camera projection matrix
+    :param camera_distortion: camera distortion vector
+    :return: the detections, with undistorted marker corners
+    """
+    marker_counts = [len(marker_corners) for marker_corners, _ in detections]
+    if sum(marker_counts) == 0:
+        return detections
+
+    corners = numpy.concatenate(
+                    [numpy.reshape(marker_corners, (-1, 1, 2))
+                     for marker_corners, _ in detections if marker_corners])
+    undistorted = cv2.undistortPoints(corners.astype(numpy.float32),
+                    camera_projection_matrix, camera_distortion,
+                    P = camera_projection_matrix).reshape(-1, 1, 4, 2)
+
+    undistorted_detections = []
+    start = 0
+    for (marker_corners, marker_ids), count in zip(detections, marker_counts):
+        if count == 0:
+            undistorted_detections.append((marker_corners, marker_ids))
+            continue
+        undistorted_detections.append(
+                        (tuple(undistorted[start:start + count]), marker_ids))
+        start += count
+    return undistorted_detections
+
+
+class MarkerDetector():
+    """
+    Detects markers from one or more ArUco dictionaries in a frame,
+    with an aruco.ArucoDetector for each dictionary made once and kept.
+    Thresholding, contour finding and quad fitting are done once per
+    frame, with the resulting candidates identified against every
+    dictionary. Where OpenCV provides a multi dictionary detector it
+    is used, otherwise the candidates found while detecting the first
+    dictionary are reused for the others, unless corner refinement or
+    inverted marker detection is on, when each dictionary is detected
+    separately.
+    """
+
+    def __init__(self, ar_dicts, single_pass = True, parameters = None,
+                 executor = None):
+        """
+        :param ar_dicts: a list of aruco dictionaries
+        :param single_pass: if false each dictionary is detected
+            separately, as aruco.detectMarkers would
+        :param parameters: aruco detector parameters, if None the
+            defaults are used
+        :param executor: an optional concurrent.futures.Executor, used
+            to detect or identify each dictionary at the same time
+        """
+        self._ar_dicts = ar_dicts
+        self._single_pass = single_pass and len(ar_dicts) > 1
+        self._executor = executor
+        self._parameters = parameters
+        if parameters is None:
+            self._parameters = aruco.DetectorParameters()
+        self._aruco_detectors = [aruco.ArucoDetector(ar_dict, self._parameters)
+                                 for ar_dict in ar_dicts]
+        self._multi_dict_detector = None
+        if self._single_pass and hasattr(aruco.ArucoDetector,
+                                         'detectMarkersMultiDict'):
+            self._multi_dict_detector = aruco.ArucoDetector(
+                            ar_dicts, self._parameters)
+        #candidates are identified without corner refinement or
+        #inverted marker detection
+        self._reuse_candidates = \
+            self._parameters.cornerRefinementMethod == \
+                            aruco.CORNER_REFINE_NONE and \
+            not self._parameters.detectInvertedMarker
+
+    def detect(self, frame):
+        """
+        Detects markers in a frame.
+
+        :param frame: the image to search
+        :return: a list with one entry per dictionary, each entry
+            a tuple of marker corners and marker ids, in the format
+            returned by aruco.detectMarkers
+        """
+        if self._multi_dict_detector is not None:
+            return self._detect_multi_dict(frame)
+
+        if not (self._single_pass and self._reuse_candidates):
+            return self._map(lambda detector:
+                             detector.detectMarkers(frame)[0:2],
+                             self._aruco_detectors)
+
+        marker_corners, marker_ids, rejected = \
+                self._aruco_detectors[0].detectMarkers(frame)
+        detections = [(marker_corners, marker_ids)]
+        candidates = list(marker_corners) + list(rejected)
+        grey = _grey(frame)
+        detections.extend(self._map(lambda ar_dict:
+                                    identify_candidates(grey, candidates,
+                                                ar_dict, self._parameters),
+                                    self._ar_dicts[1:]))
+        return detections
+
+    def dictionary_count(self):
+        """
+        :return: the number of dictionaries detected
+        """
+        return len(self._ar_dicts)
+
+    def get_parameters(self):
+        """
+        :return: the aruco detector parameters
+        """
+        return self._parameters
+
+    def get_dictionaries(self):
+        """
+        :return: the aruco dictionaries detected
+        """
+        return self._ar_dicts
+
+    def for_region(self, frame_shape, region_shape):
+        """
+        Makes a detector for searching part of a frame. Aruco's limits
+        on marker perimeter are relative to the size of the image
+        searched, so they are adjusted to be relative to the whole frame.
+        The new detector runs on the calling thread, as parts of a frame
+        are typically already being searched in parallel.
+
+        :param frame_shape: the shape of the whole frame
+        :param region_shape: the shape of the part to search
+        :return: a MarkerDetector
+        """
+        ratio = max(frame_shape[0:2]) / max(region_shape[0:2])
+        parameters = copy_parameters(self._parameters)
+        parameters.minMarkerPerimeterRate *= ratio
+        parameters.maxMarkerPerimeterRate *= ratio
+        return MarkerDetector(self._ar_dicts, self._single_pass, parameters)
+
+    def _map(self, function, items):
+        """
+        Applies function to each item, on the executor if there is one
+        :return: a list of the results, in the order of items
+        """
+        if self._executor is None:
+            return [function(item) for item in items]
+        return list(self._executor.map(function, items))
+
+    def _detect_multi_dict(self, frame):
+        """
+        Detects markers using OpenCV's multi dictionary detector
+        """
+        marker_corners, marker_ids, _, dict_indices = \
+                self._multi_dict_detector.detectMarkersMultiDict(frame)
+        detections = []
+        for dict_index in range(len(self._ar_dicts)):
+            if marker_ids is None:
+                detections.append(((), None))
+                continue
+            rows = numpy.flatnonzero(numpy.ravel(dict_indices) == dict_index)
+            if len(rows) == 0:
+                detections.append(((), None))
+                continue
+            detections.append((tuple(marker_corners[row] for row in rows),
+                               marker_ids[rows]))
+        return detections
+
+
+def regions_from_points(point_sets, frame_shape, padding = 0.5,
+                min_padding = 16):
+    """
+    Makes search regions around sets of image points. Each set gives
+    one padded bounding box, clipped to the frame. Overlapping boxes
+    are merged, so no marker is found in more than one region.
+
+    :param point_sets: a list of n x 2 arrays of image points
+    :param frame_shape: the shape of the frame
+    :param padding: the padding to add around each bounding box, as a
+        fraction of the box's largest side
+    :param min_padding: the smallest padding, in pixels
+    :return: a list of regions, each a list of [x0, y0, x1, y1]
+    """
+    height, width = frame_shape[0:2]
+    regions = []
+    for points in point_sets:
+        points = numpy.reshape(points, (-1, 2))
+        points = points[numpy.all(numpy.isfinite(points), axis = 1)]
+        if len(points) == 0:
+            continue
+        mins = numpy.min(points, axis = 0)
+        maxs = numpy.max(points, axis = 0)
+        pad = max(padding * numpy.max(maxs - mins), min_padding)
+        region = [int(max(mins[0] - pad, 0)), int(max(mins[1] - pad, 0)),
+                  int(min(maxs[0] + pad, width)),
+                  int(min(maxs[1] + pad, height))]
+        if region[2] > region[0] and region[3] > region[1]:
+            regions.append(region)
+
+    merged = True
+    while merged:
+        merged = False
+        for index, region in enumerate(regions):
+            for other in regions[index + 1:]:
+                if region[0] < other[2] and other[0] < region[2] and \
+                        region[1] < other[3] and other[1] < region[3]:
+                    region[0:4] = [min(region[0], other[0]),
+                                   min(region[1], other[1]),
+                                   max(region[2], other[2]),
+                                   max(region[3], other[3])]
+                    regions.remove(other)
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+def merge_detections(region_detections, offsets, dictionary_count):
+    """
+    Combines detections made in separate parts of a frame.
+
+    :param region_detections: a list of detections, as returned by
+        MarkerDetector.detect, one per region
+    :param offsets: the (x, y) position of each region in the frame
+    :param dictionary_count: the number of dictionaries detected
+    :return: detections for the whole frame
+    """
+    detections = []
+    for dict_index in range(dictionary_count):
+        marker_corners = []
+        marker_ids = []
+        for detection, offset in zip(region_detections, offsets):
+            corners, ids = detection[dict_index]
+            if ids is None:
+                continue
+            offset = numpy.array(offset, dtype = numpy.float32)
+            marker_corners.extend(corner + offset for corner in corners)
+            marker_ids.append(ids)
+        if marker_ids:
+            detections.append((tuple(marker_corners),
+                               numpy.concatenate(marker_ids)))
+        else:
+            detections.append(((), None))
+    return detections
+
+
+class RegionOfInterestDetector():
+    """
+    Wraps a MarkerDetector so that detection can be limited to regions
+    where markers are expected, typically around where they were
+    found in the previous frame. The whole frame is searched every
+    full_scan_interval frames, or whenever detect_full is called.
+    Each region is searched with a detector from for_region, so
+    markers are accepted by the same limits on size as in the whole
+    frame.
+    """
+
+    def __init__(self, detector, full_scan_interval = 30, padding = 0.5):
+        """
+        :param detector: the MarkerDetector, or a wrapper of one with a
+            for_region method, to use
+        :param full_scan_interval: the maximum number of frames between
+            searches of the whole frame
+        :param padding: the padding to add around each region, as a
+            fraction of the region's largest side
+        """
+        self._detector = detector
+        self._full_scan_interval = full_scan_interval
+        self._padding = padding
+        self._frames_since_full_scan = None
+        self.last_scan_was_full = False
+
+    def detect(self, frame, predicted_points):
+        """
+        Detects markers near the predicted points, or in the whole
+        frame if a full scan is due or there are no predictions.
+
+        :param frame: the image to search
+        :param predicted_points: a list of n x 2 arrays of image points
+            where markers are expected, one array per region
+        :return: detections, as returned by MarkerDetector.detect
+        """
+        regions = regions_from_points(predicted_points, frame.shape,
+                                      self._padding)
+        if not regions or self._frames_since_full_scan is None or \
+                self._frames_since_full_scan + 1 >= self._full_scan_interval:
+            return self.detect_full(frame)
+
+        self._frames_since_full_scan += 1
+        self.last_scan_was_full = False
+        crops = [frame[region[1]:region[3], region[0]:region[2]]
+                 for region in regions]
+        region_detections = [self._detector.for_region(frame.shape,
+                                                       crop.shape).detect(crop)
+                             for crop in crops]
+        return merge_detections(region_detections,
+                                [region[0:2] for region in regions],
+                                self._detector.dictionary_count())
+
+    def detect_full(self, frame):
+        """
+        Detects markers in the whole frame.
+
+        :param frame: the image to search
+        :return: detections, as returned by MarkerDetector.detect
+        """
+        self._frames_since_full_scan = 0
+        self.last_scan_was_full = True
+        return self._detector.detect(frame)
+
+
+class CornerFlowTracker():
+    """
+    Follows detected marker corners from frame to frame with pyramidal
+    Lucas-Kanade optical flow, so that full marker detection need only
+    run every few frames. Each tracked corner is checked by tracking
+    it back to the previous frame, and tracking is abandoned if any
+    corner does not return to within max_flow_error pixels of where
+    it started.
+    """
+
+    def __init__(self, detection_interval = 5, max_flow_error = 1.0,
+                 window_size = 21, pyramid_levels = 3):
+        """
+        :param detection_interval: the maximum number of frames between
+            full detections
+        :param max_flow_error: the largest forward-backward error, in
+            pixels, allowed for a tracked corner
+        :param window_size: the size of the search window used by
+            cv2.calcOpticalFlowPyrLK at each pyramid level
+        :param pyramid_levels: the number of pyramid levels to use
+        """
+        self._detection_interval = detection_interval
+        self._max_flow_error = max_flow_error
+        self._flow_parameters = {
+                        'winSize' : (window_size, window_size),
+                        'maxLevel' : pyramid_levels - 1,
+                        'criteria' : (cv2.TERM_CRITERIA_EPS |
+                                      cv2.TERM_CRITERIA_COUNT, 30, 0.01)}
+        self._grey = None
+        self._detections = None
+        self._frames_since_detection = 0
+
+    def track(self, frame):
+        """
+        Moves the markers from the previous frame to their positions
+        in this frame.
+
+        :param frame: the new image
+        :return: detections, as returned by MarkerDetector.detect, or
+            None if a full detection is due or any marker was lost
+        """
+        if self._detections is None or \
+                self._frames_since_detection + 1 >= self._detection_interval:
+            return None
+
+        marker_counts = [len(corners) for corners, _ in self._detections]
+        if sum(marker_counts) == 0:
+            return None
+
+        grey = _grey_copy(frame)
+        points = numpy.concatenate(
+                        [numpy.reshape(corners, (-1, 1, 2))
+                         for corners, _ in self._detections if corners]
+                        ).astype(numpy.float32)
+        tracked, status, _ = cv2.calcOpticalFlowPyrLK(self._grey, grey,
+                        points, None, **self._flow_parameters)
+        returned, back_status, _ = cv2.calcOpticalFlowPyrLK(grey,
+                        self._grey, tracked, None, **self._flow_parameters)
+        errors = numpy.linalg.norm((returned - points).reshape(-1, 2),
+                                   axis = 1)
+        if not (numpy.all(status) and numpy.all(back_status) and
+                numpy.all(errors <= self._max_flow_error)):
+            return None
+
+        tracked = tracked.reshape(-1, 1, 4, 2)
+        detections = []
+        start = 0
+        for (_, marker_ids), count in zip(self._detections, marker_counts):
+            if count == 0:
+                detections.append(((), None))
+                continue
+            detections.append((tuple(tracked[start:start + count]),
+                               marker_ids))
+            start += count
+
+        self._grey = grey
+        self._detections = detections
+        self._frames_since_detection += 1
+        return detections
+
+    def set_detections(self, frame, detections):
+        """
+        Sets the markers to follow, after a full detection.
+
+        :param frame: the image the markers were detected in
+        :param detections: detections, as returned by MarkerDetector.detect
+        """
+        self._grey = _grey_copy(frame)
+        self._detections = detections
+        self._frames_since_detection = 0
+
+
+class PyramidDetector():
+    """
+    Wraps a MarkerDetector so that markers are found in a downscaled
+    copy of the frame, then found again at full resolution in padded
+    regions around them, so their corners are as accurate as detecting
+    in the whole frame. Unless the detector refines corners itself,
+    they are refined with cv2.cornerSubPix, with a window sized from
+    each marker's cell size as aruco's own sub-pixel refinement does.
+    The scale is either fixed, or chosen from the size of the markers
+    seen in the previous frame so that the smallest is at least
+    target_marker_size pixels across at the detection scale.
+    Automatic scales are powers of a half.
+    """
+
+    def __init__(self, detector, scale = 'auto', target_marker_size = 40,
+                 min_scale = 0.25):
+        """
+        :param detector: the MarkerDetector to use
+        :param scale: the scale to detect at, greater than 0 and no more
+            than 1, or 'auto'
+        :param target_marker_size: for automatic scaling, the size in
+            pixels to scale the smallest marker to
+        :param min_scale: the smallest scale automatic scaling will use
+        :raise ValueError: if scale is not valid
+        """
+        self._detector = detector
+        self._auto_scale = False
+        self._scale = 1.0
+        self.set_scale(scale)
+        self._target_marker_size = target_marker_size
+        self._min_scale = min_scale
+
+    def detect(self, frame):
+        """
+        Detects markers in a frame.
+
+        :param frame: the image to search
+        :return: detections, as returned by MarkerDetector.detect, with
+            corners in full resolution frame coordinates
+        """
+        scale = self._scale
+        if scale == 1.0:
+            detections = self._detector.detect(frame)
+        else:
+            small = cv2.resize(frame, None, fx = scale, fy = scale,
+                               interpolation = cv2.INTER_AREA)
+            detections = self._refine(frame, self._detector.detect(small),
+                                      scale)
+
+        if self._auto_scale:
+            self._scale = self._choose_scale(detections)
+        return detections
+
+    def dictionary_count(self):
+        """
+        :return: the number of dictionaries detected
+        """
+        return self._detector.dictionary_count()
+
+    def for_region(self, frame_shape, region_shape):
+        """
+        Makes a detector for searching part of a frame, at the scale
+        the next frame will be detected at.
+
+        :param frame_shape: the shape of the whole frame
+        :param region_shape: the shape of the part to search
+        :return: a PyramidDetector with a fixed scale
+        """
+        return PyramidDetector(self._detector.for_region(frame_shape,
+                                                         region_shape),
+                               self._scale, self._target_marker_size,
+                               self._min_scale)
+
+    def get_scale(self):
+        """
+        :return: the scale the next frame will be detected at
+        """
+        return self._scale
+
+    def set_scale(self, scale):
+        """
+        :param scale: the scale to detect at, greater than 0 and no more
+            than 1, or 'auto'
+        :raise ValueError: if scale is not valid
+        """
+        if scale != 'auto' and not 0.0 < scale <= 1.0:
+            raise ValueError(f'Detection scale must be greater than 0 and no '
+                             f'more than 1, or auto, not {scale}')
+        self._auto_scale = scale == 'auto'
+        if not self._auto_scale:
+            self._scale = scale
+
+    def _refine(self, frame, detections, scale):
+        """
+        Maps markers found at a reduced scale back to the full
+        resolution frame, and detects them again there
+        """
+        point_sets = [(numpy.reshape(marker_corners, (-1, 2)) + 0.5) /
+                      scale - 0.5 for corners, _ in detections
+                      for marker_corners in corners]
+        if not point_sets:
+            return detections
+
+        regions = regions_from_points(point_sets, frame.shape)
+        region_detections = []
+        for region in regions:
+            crop = frame[region[1]:region[3], region[0]:region[2]]
+            region_detections.append(_remove_cut_markers(
+                            self._detector.for_region(frame.shape,
+                                                      crop.shape).detect(crop),
+                            region, frame.shape))
+        detections = merge_detections(region_detections,
+                                [region[0:2] for region in regions],
+                                self._detector.dictionary_count())
+
+        parameters = self._detector.get_parameters()
+        if parameters.cornerRefinementMethod != aruco.CORNER_REFINE_NONE:
+            return detections
+        grey = _grey(frame)
+        return [(tuple(refine_corners(grey, marker_corners,
+                                      ar_dict.markerSize, parameters)
+                       for marker_corners in corners), marker_ids)
+                for (corners, marker_ids), ar_dict in
+                zip(detections, self._detector.get_dictionaries())]
+
+    def _choose_scale(self, detections):
+        """
+        Picks the scale for the next frame from the smallest marker
+        in this one. Full resolution is used after a frame with no
+        markers, in case the markers were too small to find.
+        """
+        corners = [numpy.reshape(marker_corners, (-1, 4, 2))
+                   for marker_corners, _ in detections if marker_corners]
+        if not corners:
+            return 1.0
+        corners = numpy.concatenate(corners)
+        sides = numpy.linalg.norm(corners - numpy.roll(corners, 1, axis = 1),
+                                  axis = 2)
+        scale = self._target_marker_size / numpy.min(sides)
+        #powers of a half, as resizing by integer factors is quickest
+        scale = 0.5 ** numpy.floor(-numpy.log2(min(scale, 1.0)))
+        return float(max(scale, self._min_scale))
+
+
+def refine_corners(grey, marker_corners, marker_size, parameters):
+    """
+    Refines a marker's corners to sub-pixel accuracy, as aruco's
+    CORNER_REFINE_SUBPIX does. The cv2.cornerSubPix window is sized
+    from the marker's cell size, and never reaches past one cell, so
+    the corners are not drawn to the corners of the marker's bits.
+
+    :param grey: the greyscale image
+    :param marker_corners: a 1x4x2 array of the marker's corners
+    :param marker_size: the number of bits along a side of the marker,
+        not counting the border
+    :param parameters: aruco detector parameters, giving the relative
+        and largest window size, border width and stopping criteria
+    :return: the refined corners, as a 1x4x2 float32 array
+    """
+    corners = numpy.array(marker_corners, dtype = numpy.float32)
+    corners = corners.reshape((-1, 1, 2))
+    sides = numpy.linalg.norm(corners - numpy.roll(corners, 1, axis = 0),
+                              axis = 2)
+    cell_size = numpy.mean(sides) / (marker_size +
+                                     2 * parameters.markerBorderBits)
+    #the relative window size is not available before OpenCV 4.9
+    window = round(getattr(parameters, 'relativeCornerRefinmentWinSize',
+                           0.3) * cell_size)
+    window = min(window, parameters.cornerRefinementWinSize,
+                 int(numpy.ceil(cell_size)) - 1)
+    window = max(window, 1)
+    cv2.cornerSubPix(grey, corners, (window, window), (-1, -1),
+                     (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                      parameters.cornerRefinementMaxIterations,
+                      parameters.cornerRefinementMinAccuracy))
+    return corners.reshape((1, 4, 2))
+
+
+def tile_regions(frame_shape, tiles, overlap):
+    """
+    Splits a frame into a grid of overlapping tiles. Any marker no
+    more than overlap pixels across lies wholly inside at least
+    one tile.
+
+    :param frame_shape: the shape of the frame
+    :param tiles: the number of columns and rows of tiles
+    :param overlap: the width in pixels of the overlap between
+        neighbouring tiles
+    :return: a list of regions, each a list of [x0, y0, x1, y1]
+    """
+    height, width = frame_shape[0:2]
+    columns, rows = tiles
+    x_edges = numpy.linspace(0, width, columns + 1).astype(int)
+    y_edges = numpy.linspace(0, height, rows + 1).astype(int)
+    half_overlap = int(numpy.ceil(overlap / 2))
+    regions = []
+    for row in range(rows):
+        for column in range(columns):
+            regions.append([max(x_edges[column] - half_overlap, 0),
+                            max(y_edges[row] - half_overlap, 0),
+                            min(x_edges[column + 1] + half_overlap, width),
+                            min(y_edges[row + 1] + half_overlap, height)])
+    return regions
+
+
+def remove_duplicate_markers(detections):
+    """
+    Removes markers that were found more than once, as happens where
+    detection regions overlap. Markers with the same id are taken to be
+    the same marker if their centres are closer than half the marker's
+    side length, in which case the first one is kept.
+
+    :param detections: detections, as returned by MarkerDetector.detect
+    :return: the detections without duplicates
+    """
+    unique_detections = []
+    for marker_corners, marker_ids in detections:
+        if marker_ids is None:
+            unique_detections.append((marker_corners, marker_ids))
+            continue
+        corners = numpy.reshape(marker_corners, (-1, 4, 2))
+        centres = numpy.mean(corners, axis = 1)
+        sides = numpy.linalg.norm(corners[:, 0] - corners[:, 1], axis = 1)
+        flat_ids = numpy.ravel(marker_ids)
+        keep = []
+        for index, marker_id in enumerate(flat_ids):
+            if not any(flat_ids[kept] == marker_id and
+                       numpy.linalg.norm(centres[kept] - centres[index]) <
+                       0.5 * sides[index] for kept in keep):
+                keep.append(index)
+        unique_detections.append((tuple(marker_corners[index]
+                                        for index in keep),
+                                  marker_ids[keep]))
+    return unique_detections
+
+
+def _remove_cut_markers(detections, region, frame_shape, margin = 2):
+    """
+    Removes markers touching an edge of a region that is not also an
+    edge of the frame. These may be cut by the edge, and so wrongly
+    identified, and will be wholly inside a neighbouring tile.
+
+    :param detections: detections within the region
+    :param region: the region, as [x0, y0, x1, y1]
+    :param frame_shape: the shape of the whole frame
+    :param margin: how close to the edge in pixels a corner must be
+        to count as touching it
+    """
+    height, width = frame_shape[0:2]
+    low = numpy.array([margin if region[0] > 0 else -numpy.inf,
+                       margin if region[1] > 0 else -numpy.inf])
+    high = numpy.array([region[2] - region[0] - 1 - margin
+                        if region[2] < width else numpy.inf,
+                        region[3] - region[1] - 1 - margin
+                        if region[3] < height else numpy.inf])
+    kept_detections = []
+    for marker_corners, marker_ids in detections:
+        if marker_ids is None:
+            kept_detections.append((marker_corners, marker_ids))
+            continue
+        corners = numpy.reshape(marker_corners, (-1, 4, 2))
+        keep = numpy.flatnonzero(numpy.all((corners >= low) &
+                                           (corners <= high), axis = (1, 2)))
+        if len(keep) == 0:
+            kept_detections.append(((), None))
+            continue
+        kept_detections.append((tuple(marker_corners[index]
+                                      for index in keep), marker_ids[keep]))
+    return kept_detections
+
+
+class TiledDetector():
+    """
+    Wraps a MarkerDetector so that a large frame is split into
+    overlapping tiles, which are searched at the same time on a pool
+    of threads. OpenCV releases the GIL while detecting, so the tiles
+    are searched in parallel. Markers cut by the edge of a tile are
+    ignored, and markers found in more than one tile are only
+    reported once.
+    """
+
+    def __init__(self, detector, executor, tiles = (2, 2), overlap = 128):
+        """
+        :param detector: the MarkerDetector to use
+        :param executor: a concurrent.futures.Executor to search tiles with
+        :param tiles: the number of columns and rows of tiles
+        :param overlap: the overlap between tiles, in pixels. Markers
+            that cross a tile boundary may be missed unless they are
+            smaller than this
+        """
+        self._detector = detector
+        self._executor = executor
+        self._tiles = tiles
+        self._overlap = overlap
+        self._tile_detectors = {}
+
+    def detect(self, frame):
+        """
+        Detects markers in a frame.
+
+        :param frame: the image to search
+        :return: detections, as returned by MarkerDetector.detect
+        """
+        regions = tile_regions(frame.shape, self._tiles, self._overlap)
+        tiles = [frame[region[1]:region[3], region[0]:region[2]]
+                 for region in regions]
+        region_detections = list(self._executor.map(
+                        lambda tile: self._tile_detector(frame.shape,
+                                                         tile.shape)
+                                        .detect(tile), tiles))
+        region_detections = [
+                        _remove_cut_markers(detections, region, frame.shape)
+                        for detections, region in zip(region_detections,
+                                                      regions)]
+        return remove_duplicate_markers(merge_detections(region_detections,
+                                [region[0:2] for region in regions],
+                                self._detector.dictionary_count()))
+
+    def dictionary_count(self):
+        """
+        :return: the number of dictionaries detected
+        """
+        return self._detector.dictionary_count()
+
+    def get_parameters(self):
+        """
+        :return: the aruco detector parameters
+        """
+        return self._detector.get_parameters()
+
+    def get_dictionaries(self):
+        """
+        :return: the aruco dictionaries detected
+        """
+        return self._detector.get_dictionaries()
+
+    def for_region(self, frame_shape, region_shape):
+        """
+        Makes a detector for searching part of a frame in tiles.
+
+        :param frame_shape: the shape of the whole frame
+        :param region_shape: the shape of the part to search
+        :return: a TiledDetector
+        """
+        return TiledDetector(self._detector.for_region(frame_shape,
+                                                       region_shape),
+                             self._executor, self._tiles, self._overlap)
+
+    def _tile_detector(self, frame_shape, tile_shape):
+        """
+        :return: the detector to search a tile of the given shape with
+        """
+        key = (frame_shape[0:2], tile_shape[0:2])
+        if key not in self._tile_detectors:
+            self._tile_detectors[key] = self._detector.for_region(
+                            frame_shape, tile_shape)
+        return self._tile_detectors[key]
+
+
+class MotionGate():
+    """
+    Decides whether a frame has changed enough since the last processed
+    frame to be worth searching for markers. Frames are compared by the
+    mean absolute difference of heavily downsampled greyscale copies.
+    """
+
+    def __init__(self, threshold = 2.0, max_skipped_frames = 30,
+                 size = (32, 24)):
+        """
+        :param threshold: the mean absolute difference in grey level
+            below which a frame is treated as unchanged
+        :param max_skipped_frames: the most frames in a row that may be
+            treated as unchanged
+        :param size: the width and height to downsample frames to
+        """
+        self._threshold = threshold
+        self._max_skipped_frames = max_skipped_frames
+        self._size = size
+        self._reference = None
+        self._skipped_frames = 0
+
+    def is_static(self, frame):
+        """
+        Compares a frame with the last frame that was not static. If
+        the frame is not static it becomes the frame to compare with.
+
+        :param frame: the new image
+        :return: True if the frame can be treated as unchanged
+        """
+        small = cv2.resize(_grey(frame), self._size,
+                           interpolation = cv2.INTER_AREA).astype(numpy.int16)
+        if self._reference is not None and \
+                self._skipped_frames < self._max_skipped_frames and \
+                numpy.mean(numpy.abs(small - self._reference)) < \
+                        self._threshold:
+            self._skipped_frames += 1
+            return True
+
+        self._reference = small
+        self._skipped_frames = 0
+        return False
@@ -0,0 +1,105 @@
+""" Classes for keeping tracking within a latency budget """
+
+#the degradation levels, in order. Each gives whether to limit detection
+#to regions of interest, the largest detection scale, and the number of
+#frames to skip after each processed frame
+LATENCY_LEVELS = ((False, 1.0, 0),
+                  (True, 1.0, 0),
+                  (True, 0.5, 0),
+                  (True, 0.5, 1),
+                  (True, 0.25, 2))
+
+
+class LatencyController():
+    """
+    Watches how long each frame takes to process and picks a level of
+    degradation to keep within a time budget. Level 0 is the tracker as
+    configured. Higher levels search only regions of interest, detect
+    at a reduced scale, and then skip frames, reusing the last result.
+
+    The level goes up when the smoothed frame time is over budget, and
+    down when it is under down_fraction of the budget. The level is not
+    changed again until it has been used for min_frames frames.
+    """
+
+    def __init__(self, budget = 0.02, smoothing = 0.2, min_frames = 10,
+                 down_fraction = 0.5):
+        """
+        :param budget: the target time to process a frame, in seconds
+        :param smoothing: the weight given to each new frame time in
+            the exponential moving average of frame times
+        :param min_frames: the number of processed frames to stay at
+            a level before changing it again
+        :param down_fraction: the fraction of the budget the smoothed
+            frame time must fall below before the level goes down
+        :raise ValueError: if budget is not positive
+        """
+        if budget <= 0.0:
+            raise ValueError(f'Latency budget must be positive, not {budget}')
+        self._budget = budget
+        self._smoothing = smoothing
+        self._min_frames = min_frames
+        self._down_fraction = down_fraction
+        self._level = 0
+        self._frames_at_level = 0
+        self._frames_to_skip = 0
+        self._mean_time = None
+
+    def update(self, frame_time):
+        """
+        Records the time taken to process a frame, and changes level
+        if necessary.
+
+        :param frame_time: the time taken, in seconds
+        :return: True if the level changed
+        """
+        if self._mean_time is None:
+            self._mean_time = frame_time
+        self._mean_time += self._smoothing * (frame_time - self._mean_time)
+        self._frames_at_level += 1
+        self._frames_to_skip = LATENCY_LEVELS[self._level][2]
+        if self._frames_at_level < self._min_frames:
+            return False
+
+        level = self._level
+        if self._mean_time > self._budget:
+            level = min(level + 1, len(LATENCY_LEVELS) - 1)
+        elif self._mean_time < self._down_fraction * self._budget:
+            level = max(level - 1, 0)
+        if level == self._level:
+            return False
+
+        self._level = level
+        self._frames_at_level = 0
+        self._frames_to_skip = LATENCY_LEVELS[level][2]
+        return True
+
+    def skip_frame(self):
+        """
+        :return: True if the next frame should be skipped
+        """
+        if self._frames_to_skip > 0:
+            self._frames_to_skip -= 1
+            return True
+        return False
+
+    def get_level(self):
+        """
+        :return: the current level, 0 for no degradation
+        """
+        return self._level
+
+    def get_settings(self):
+        """
+        :return: whether to limit detection to regions of interest, the
+            largest detection scale to use, and the number of frames to
+            skip after each processed frame, at the current level
+        """
+        return LATENCY_LEVELS[self._level]
+
+    def get_mean_time(self):
+        """
+        :return: the smoothed time to process a frame, in seconds, or
+            None before the first frame
+        """
+        return self._mean_time
@@ -16,6 +16,118 @@ def _marker_size(marker_points):
     size = np.linalg.norm(maxs - mins)
     return size
 
+#rotation of 180 degrees about the x axis, relating square tags defined
+#with y increasing downwards to the square tag convention used by OpenCV
+_FLIP_Y = np.diag([1.0, -1.0, -1.0])
+
+def _square_template(corner_points):
+    """
+    Internal function returning the corner points of a square tag in
+    the order and orientation required by cv2.SOLVEPNP_IPPE_SQUARE,
+    with the same size as corner_points, and whether corner_points
+    needs its y axis flipped to match. None if corner_points is not
+    a square tag centred on the origin.
+
+    :param corner_points: a 4x3 array of tag corners
+    """
+    half_width = np.max(np.abs(corner_points[:, 0:2]))
+    template = np.array([[-half_width, half_width, 0.],
+                         [half_width, half_width, 0.],
+                         [half_width, -half_width, 0.],
+                         [-half_width, -half_width, 0.]], dtype = np.float32)
+    tolerance = 1e-4 * half_width
+    if np.allclose(corner_points, template, rtol = 0., atol = tolerance):
+        return template, False
+    if np.allclose(corner_points, template @ _FLIP_Y, rtol = 0.,
+                   atol = tolerance):
+        return template, True
+    return None, False
+
+
+def select_pnp_solver(corner_points):
+    """
+    Picks the fastest suitable pose estimation method for a board.
+    IPPE_SQUARE is used for boards made of a single square tag,
+    IPPE for other planar boards, and SQPNP otherwise.
+
+    :param corner_points: an n x 4 x 3 array of the board's tag corners
+    :return: a cv2.SOLVEPNP flag
+    """
+    corner_points = np.reshape(corner_points, (-1, 4, 3))
+    if len(corner_points) == 1:
+        template, _ = _square_template(corner_points[0])
+        if template is not None:
+            return cv2.SOLVEPNP_IPPE_SQUARE
+
+    points = corner_points.reshape(-1, 3)
+    singular_values = np.linalg.svd(points - np.mean(points, axis = 0),
+                                    compute_uv = False)
+    if singular_values[-1] <= 1e-6 * singular_values[0]:
+        return cv2.SOLVEPNP_IPPE
+    return cv2.SOLVEPNP_SQPNP
+
+
+def _solve_pnp(points3d, points2d, camera_projection_matrix,
+                camera_distortion, solver):
+    """
+    Internal function that calls cv2.solvePnP with the chosen method,
+    matching the board's tag corners to the layout required by
+    IPPE_SQUARE where necessary.
+    """
+    if solver != cv2.SOLVEPNP_IPPE_SQUARE:
+        return cv2.solvePnP(points3d, points2d, camera_projection_matrix,
+                            camera_distortion, flags = solver)
+
+    template, flip_y = _square_template(points3d)
+    if template is None:
+        raise ValueError("IPPE_SQUARE can only be used with rigid bodies "
+                         "made of a single square tag centred on the origin")
+    success, rvecs, tvecs = cv2.solvePnP(template, points2d,
+                            camera_projection_matrix, camera_distortion,
+                            flags = solver)
+    if flip_y:
+        rvecs, _ = cv2.Rodrigues(cv2.Rodrigues(rvecs)[0] @ _FLIP_Y)
+    return success, rvecs, tvecs
+
+
+def tracking_matrices(tracking_rots, tracking_trans, out = None):
+    """
+    Converts rotation and translation vectors to 4x4 tracking matrices
+    for any number of tools at once.
+
+    :param tracking_rots: a list of n rotation vectors
+    :param tracking_trans: a list of n translation vectors
+    :param out: an optional n x 4 x 4 array to write the result into
+    :return: an n x 4 x 4 array of tracking matrices, NaN where the
+        rotation or translation is NaN
+    """
+    rvecs = np.reshape([np.ravel(rvec) for rvec in tracking_rots], (-1, 3))
+    tvecs = np.reshape([np.ravel(tvec) for tvec in tracking_trans], (-1, 3))
+    if out is None:
+        out = np.empty((len(rvecs), 4, 4), dtype = np.float64)
+
+    angles = np.linalg.norm(rvecs, axis = 1)
+    axes = rvecs / np.where(angles > 0, angles, 1.0)[:, None]
+    cross = np.zeros((len(rvecs), 3, 3))
+    cross[:, 0, 1] = -axes[:, 2]
+    cross[:, 0, 2] = axes[:, 1]
+    cross[:, 1, 0] = axes[:, 2]
+    cross[:, 1, 2] = -axes[:, 0]
+    cross[:, 2, 0] = -axes[:, 1]
+    cross[:, 2, 1] = axes[:, 0]
+
+    out[:] = 0.0
+    out[:, 0:3, 0:3] = np.eye(3) + \
+                    np.sin(angles)[:, None, None] * cross + \
+                    (1.0 - np.cos(angles))[:, None, None] * (cross @ cross)
+    out[:, 0:3, 3] = tvecs
+    out[:, 3, 3] = 1.0
+
+    invalid = np.isnan(rvecs).any(axis = 1) | np.isnan(tvecs).any(axis = 1)
+    out[invalid, 0:3, :] = np.nan
+    return out
+
+
 def estimate_poses_no_calibration(marker_corners, aruco_board):
     """
     Returns tracking data for a camera with no calibration data.
@@ -52,8 +164,61 @@ def estimate_poses_no_calibration(marker_corners, aruco_board):
 
     return tracking_rot, tracking_trans, quality
 
+def _reprojection_error(points3d, points2d, pose,
+                camera_projection_matrix, camera_distortion):
+    """
+    Internal function to calculate the root mean square reprojection
+    error of a pose, in pixels
+
+    :param pose: a rotation vector and a translation vector
+    """
+    projected, _ = cv2.projectPoints(points3d, pose[0], pose[1],
+                                     camera_projection_matrix,
+                                     camera_distortion)
+    residuals = projected.reshape(-1, 2) - points2d
+    return np.sqrt(np.mean(np.sum(residuals * residuals, axis = 1)))
+
+
+def estimate_single_tag_poses(marker_corners2d, tag_width,
+                camera_projection_matrix, camera_distortion):
+    """
+    Estimates the poses of any number of square tags of the same size
+    in one call, giving the same results as
+    cv2.aruco.estimatePoseSingleMarkers, which is deprecated.
+    Each pose has its origin at the tag centre, with the tag corners
+    in the order detected by cv2.aruco.
+
+    :param marker_corners2d: a list of 2d marker corners, 1 row per tag,
+        8 columns per tag
+    :param tag_width: the width of the tags in mm
+    :param camera_projection_matrix: a 3x3 camera projection matrix
+    :param camera_distortion: camera distortion vector
+
+    :return: an n x 3 array of rotation vectors and an n x 3 array of
+        translation vectors, one row per tag
+    """
+    half_width = tag_width / 2.0
+    object_points = np.array([[-half_width, half_width, 0.],
+                              [half_width, half_width, 0.],
+                              [half_width, -half_width, 0.],
+                              [-half_width, -half_width, 0.]],
+                             dtype = np.float32)
+    image_points = np.reshape(marker_corners2d, (-1, 4, 2))
+    rvecs = np.empty((len(image_points), 3), dtype = np.float64)
+    tvecs = np.empty((len(image_points), 3), dtype = np.float64)
+    for index, tag_points in enumerate(image_points):
+        _, rvec, tvec = cv2.solvePnP(object_points, tag_points,
+                                     camera_projection_matrix,
+                                     camera_distortion)
+        rvecs[index] = rvec[:, 0]
+        tvecs[index] = tvec[:, 0]
+    return rvecs, tvecs
+
+
 def estimate_poses_with_calibration(marker_corners2d, marker_ids,
-                aruco_board, camera_projection_matrix, camera_distortion):
+                aruco_board, camera_projection_matrix, camera_distortion,
+                *, pose_guess = None, max_reprojection_error = 2.0,
+                solver = None, board_rows = None):
     """
     Estimate the pose of a single tag or a multi-tag rigid body
     when the camera calibration is known.
@@ -63,6 +228,21 @@ def estimate_poses_with_calibration(marker_corners2d, marker_ids,
         1 row per tag, 15 columns per tag: corner points and centre point
     :param camera_projection_matrix: a 3x3 camera projection matrix
     :param camera_distortion: camera distortion vector
+    :param pose_guess: an optional rotation and translation vector,
+        typically the previous frame's pose, used as the starting
+        point for multi-tag pose estimation
+    :param max_reprojection_error: if the pose found starting from
+        pose_guess has a larger root mean square reprojection error
+        (in pixels) than this, or is behind the camera, pose estimation
+        is repeated without the guess
+    :param solver: the cv2.SOLVEPNP method to use. If None, single
+        tags are handled by cv2.aruco.estimatePoseSingleMarkers and
+        multiple tags by the iterative method. Otherwise every pose
+        is found with the chosen method from the tag corners defined
+        in aruco_board
+    :param board_rows: an optional array giving the row of each marker
+        in aruco_board, as found when the markers were assigned to the
+        rigid body. If None the rows are looked up from marker_ids
 
     :return : a tracking rotation, translation and a quality
     """
@@ -74,35 +254,46 @@ def estimate_poses_with_calibration(marker_corners2d, marker_ids,
     if len(marker_corners2d) == 0:
         return tracking_rot, tracking_trans, quality
 
-    if len(marker_corners2d) == 1:
+    if len(marker_corners2d) == 1 and solver is None:
         marker_width = aruco_board.corner_points[0][1][0] \
                         - aruco_board.corner_points[0][0][0]
-        rvecs, tvecs, _ = \
-            cv2.aruco.estimatePoseSingleMarkers(marker_corners2d, marker_width,
+        rvecs, tvecs = \
+            estimate_single_tag_poses(marker_corners2d, marker_width,
                                             camera_projection_matrix,
                                             camera_distortion)
         assert len(rvecs) == 1
-        return rvecs[0], tvecs[0][0], quality
-
-    points3d = []
-    points2d = []
-    count = 0
-
-    for index, identities in enumerate(marker_ids):
-        for three_d_index, three_d_marker_id in enumerate(aruco_board.ids):
-            if identities == three_d_marker_id:
-                count += 1
-                points3d.extend(aruco_board.corner_points[three_d_index])
-                points2d.extend(marker_corners2d[index])
-                break
-
-    if count > 0:
-        points3d = np.array(points3d).reshape((count*4), 3)
-        points2d = np.array(points2d).reshape((count*4), 2)
-
-    _, rvecs, tvecs = \
-        cv2.solvePnP(points3d, points2d,
+        return rvecs[0:1], tvecs[0], quality
+
+    rows = board_rows
+    if rows is None:
+        rows = aruco_board.get_rows(marker_ids)
+    rows = np.asarray(rows, dtype = int)
+    found = rows >= 0
+    points3d = aruco_board.corner_points[rows[found]].reshape(-1, 3)
+    points2d = np.reshape(marker_corners2d, (-1, 4, 2))[found].reshape(-1, 2)
+    if not found.any():
+        return tracking_rot, tracking_trans, quality
+
+    if pose_guess is not None:
+        rvec = np.array(pose_guess[0], dtype = np.float64).reshape(3, 1)
+        tvec = np.array(pose_guess[1], dtype = np.float64).reshape(3, 1)
+        success, rvecs, tvecs = \
+            cv2.solvePnP(points3d, points2d,
                                     camera_projection_matrix,
-                                    camera_distortion)
+                                    camera_distortion,
+                                    rvec, tvec, useExtrinsicGuess = True)
+        #the mirror image pose, behind the camera, reprojects equally well
+        if success and tvecs[2][0] > 0 and \
+                _reprojection_error(points3d, points2d,
+                        (rvecs, tvecs), camera_projection_matrix,
+                        camera_distortion) \
+                                <= max_reprojection_error:
+            return rvecs[:,0], tvecs, quality
+
+    if solver is None:
+        solver = cv2.SOLVEPNP_ITERATIVE
+    _, rvecs, tvecs = _solve_pnp(points3d, points2d,
+                                 camera_projection_matrix,
+                                 camera_distortion, solver)
 
     return rvecs[:,0], tvecs, quality
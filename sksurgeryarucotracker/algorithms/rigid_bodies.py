@@ -1,9 +1,12 @@
 """ Classes and functions for maintaining ArUco rigid bodies """
 
+from collections import OrderedDict
 import numpy
+import cv2
 from cv2 import aruco
 from sksurgeryarucotracker.algorithms.registration_2d3d import \
-                estimate_poses_no_calibration, estimate_poses_with_calibration
+                estimate_poses_no_calibration, \
+                estimate_poses_with_calibration, select_pnp_solver
 
 
 class Board():
@@ -20,15 +23,30 @@ class Board():
         if number_of_markers != len(marker_ids):
             raise ValueError("Unequal number of markers detected in"+
                 " markerpoints and marker_ids")
-        self.corner_points = []
-        for marker_index in range(number_of_markers):
-            cornerpoints = markerpoints[marker_index]
-            assert len(cornerpoints) == 12
-            cornerpoints.shape=(4,3)
-            self.corner_points.append(cornerpoints)
+        self.corner_points = numpy.ascontiguousarray(markerpoints,
+                        dtype = numpy.float32).reshape(number_of_markers, 4, 3)
         self.dictionary = dictionary
         self.ids = marker_ids
 
+        flat_ids = numpy.ravel(marker_ids).astype(int)
+        self._id_order = numpy.argsort(flat_ids, kind = 'stable')
+        self._sorted_ids = flat_ids[self._id_order]
+
+    def get_rows(self, marker_ids):
+        """
+        Finds the rows of the board that match a list of marker ids
+
+        :param marker_ids: a list or array of marker ids
+        :return: an array with the matching row for each marker id,
+            -1 where the marker is not part of the board
+        """
+        flat_ids = numpy.ravel(numpy.asarray(marker_ids, dtype = int))
+        positions = numpy.searchsorted(self._sorted_ids, flat_ids)
+        positions = numpy.minimum(positions, len(self._sorted_ids) - 1)
+        rows = self._id_order[positions]
+        rows[self._sorted_ids[positions] != flat_ids] = -1
+        return rows
+
 
 def _make_aruco_board(markers, dictionary):
     """
@@ -107,10 +125,17 @@ def configure_rigid_bodies(configuration):
 
         rigid_body.load_3d_points(filename, dictionary_name)
 
+        rigid_body.set_warm_start(rigid_body_config.get('warm start', False),
+                rigid_body_config.get('max reprojection error', 2.0))
+
         tag_width = rigid_body_config.get('tag width', None)
         if tag_width is not None:
             rigid_body.scale_3d_tags(tag_width)
 
+        rigid_body.set_pnp_solver(rigid_body_config.get('pnp solver', None))
+        rigid_body.set_max_corner_motion(
+                        rigid_body_config.get('max corner motion', None))
+
         rigid_bodies.append(rigid_body)
         if dictionary_name not in ar_dict_names:
             ar_dict_names.append(dictionary_name)
@@ -149,36 +174,219 @@ def scale_tags(board, measured_pattern_width):
     :param measured_pattern_width: Width of the tag in mm
     """
 
-    number_of_tags=len(board.corner_points)
-    model_pattern_width = min(numpy.ptp([i[:, 0] for i in board.corner_points]),
-                              numpy.ptp([i[:, 1] for i in board.corner_points]))
+    model_pattern_width = min(numpy.ptp(board.corner_points[:, :, 0]),
+                              numpy.ptp(board.corner_points[:, :, 1]))
     scale_factor = measured_pattern_width/model_pattern_width
-    scaled_board = []
-    for tag in board.corner_points:
-        tag *= scale_factor
-        scaled_board.append(tag)
+    scaled_board = board.corner_points * scale_factor
+    return Board(scaled_board, board.dictionary, board.ids)
+
+
+class MarkerIndex():
+    """
+    A lookup from (dictionary, marker id) to (rigid body, board row),
+    built once at configuration so that detected markers can be
+    routed to their rigid bodies with a single vectorised comparison
+    """
+
+    def __init__(self, ar_dict_names, rigid_bodies):
+        """
+        :param ar_dict_names: the names of the dictionaries in use
+        :param rigid_bodies: the list of rigid bodies to route markers to
+        """
+        self._rigid_bodies = rigid_bodies
+        self._marker_ids = []
+        self._body_indices = []
+        self._board_rows = []
+        for dictionary_name in ar_dict_names:
+            marker_ids = []
+            body_indices = []
+            board_rows = []
+            for body_index, rigid_body in enumerate(rigid_bodies):
+                if rigid_body.get_dictionary_name() != dictionary_name:
+                    continue
+                board_ids = numpy.ravel(rigid_body.get_marker_ids())
+                marker_ids.extend(board_ids)
+                body_indices.extend([body_index] * len(board_ids))
+                board_rows.extend(range(len(board_ids)))
+            self._marker_ids.append(numpy.array(marker_ids, dtype = int))
+            self._body_indices.append(numpy.array(body_indices, dtype = int))
+            self._board_rows.append(numpy.array(board_rows, dtype = int))
+
+    def assign(self, dict_index, marker_corners, marker_ids):
+        """
+        Assigns detected markers to the rigid bodies they belong to.
+
+        :param dict_index: the index of the dictionary the markers
+            were detected with
+        :param marker_corners: marker corners as returned by
+            aruco.detectMarkers
+        :param marker_ids: marker ids as returned by aruco.detectMarkers
+
+        :return: a boolean array, true for each marker that was not
+            assigned to a rigid body
+        """
+        detected_ids = numpy.ravel(marker_ids)
+        unassigned = numpy.ones(len(detected_ids), dtype = bool)
+        detected_rows, index_rows = numpy.nonzero(
+            detected_ids[:, None] == self._marker_ids[dict_index][None, :])
+        if len(detected_rows) == 0:
+            return unassigned
+
+        unassigned[detected_rows] = False
+        body_indices = self._body_indices[dict_index][index_rows]
+        board_rows = self._board_rows[dict_index][index_rows]
+        for body_index in numpy.unique(body_indices):
+            matched = body_indices == body_index
+            self._rigid_bodies[body_index].add_2d_points(
+                [marker_corners[row] for row in detected_rows[matched]],
+                detected_ids[detected_rows[matched]],
+                board_rows[matched])
+        return unassigned
+
+    def visible_tools(self, detections):
+        """
+        Finds which tools can be seen, without assigning any markers.
+
+        :param detections: a list of marker corners and marker ids per
+            dictionary, as returned by MarkerDetector.detect
+        :return: a set holding the index of each rigid body with at least
+            one marker detected, and (dictionary index, marker id) for
+            each marker that is not part of a rigid body
+        """
+        tools = set()
+        for dict_index, (_, marker_ids) in enumerate(detections):
+            if marker_ids is None:
+                continue
+            detected_ids = numpy.ravel(marker_ids)
+            matches = detected_ids[:, None] == \
+                            self._marker_ids[dict_index][None, :]
+            tools.update(self._body_indices[dict_index][
+                            numpy.any(matches, axis = 0)].tolist())
+            tools.update((dict_index, int(marker_id)) for marker_id in
+                         detected_ids[~numpy.any(matches, axis = 1)])
+        return tools
+
+
+class SingleTagCache():
+    """
+    A bounded least recently used cache of the rigid bodies used to
+    track single tags that do not belong to a configured rigid body,
+    so that they are not rebuilt every frame
+    """
+
+    def __init__(self, tag_size, max_size = 256):
+        """
+        :param tag_size: tag size in mm
+        :param max_size: the maximum number of rigid bodies to keep,
+            the least recently seen are evicted first
+        """
+        self._tag_size = tag_size
+        self._max_size = max_size
+        self._rigid_bodies = OrderedDict()
+
+    def get(self, dictionary_name, marker_id, dictionary):
+        """
+        Returns a rigid body for a single tag, with its 2D points cleared
+
+        :param dictionary_name: the name of the dictionary
+        :param marker_id: the marker id
+        :param dictionary: the aruco dictionary
+        """
+        key = (dictionary_name, marker_id)
+        rigid_body = self._rigid_bodies.get(key)
+        if rigid_body is None:
+            rigid_body = ArUcoRigidBody(str(dictionary_name) + ":" +
+                                        str(marker_id))
+            rigid_body.add_single_tag(self._tag_size, marker_id, dictionary)
+            self._rigid_bodies[key] = rigid_body
+            if len(self._rigid_bodies) > self._max_size:
+                self._rigid_bodies.popitem(last = False)
+        else:
+            self._rigid_bodies.move_to_end(key)
+            rigid_body.reset_2d_points()
+        return rigid_body
+
+    def __len__(self):
+        return len(self._rigid_bodies)
 
-    scaled_board_np = numpy.array(scaled_board)
-    scaled_board_np.shape = (number_of_tags, 12)
-    return Board(scaled_board_np, board.dictionary, board.ids)
 
 class TwoDTags():
     """
-    Stores two linked arrays, on of tag IDs and the other
-    2D points
+    Stores three linked arrays, one of tag IDs, one of
+    2D points, and one of the matching rows in the board
     """
 
     def __init__(self):
         self.points = []
         self.ids = []
+        self.board_rows = []
 
-    def append_tag(self, tag_id, points):
+    def append_tag(self, tag_id, points, board_row = None):
         """ Adds a tag to the two point list
         :param tag_id: The id of the tag
         :param points: 4 points defining the tag corners
+        :param board_row: The row of the tag in the rigid body's board
         """
         self.points.append(points)
         self.ids.append(tag_id)
+        self.board_rows.append(board_row)
+
+
+class CornerMotionGate():
+    """
+    Remembers the tag corners a pose was estimated from, so that the
+    pose can be reused while the same tags are seen and none of their
+    corners have moved further than max_corner_motion pixels. Motion is
+    measured from the corners used for the estimate, not from the last
+    frame, so slow drift still leads to a new estimate.
+    """
+
+    def __init__(self, max_corner_motion):
+        """
+        :param max_corner_motion: the largest corner motion in pixels
+        """
+        self._max_corner_motion = max_corner_motion
+        self._tag_ids = None
+        self._points = None
+        self._pose = None
+        self._hits = 0
+        self._misses = 0
+
+    def get_pose(self, tag_ids, points):
+        """
+        :param tag_ids: the ids of the tags seen
+        :param points: an n x 2 array of the tag corners
+        :return: the last pose, if it can be reused, otherwise None
+        """
+        if len(tag_ids) > 0 and self._tag_ids is not None and \
+                numpy.array_equal(tag_ids, self._tag_ids) and \
+                numpy.max(numpy.abs(points - self._points)) <= \
+                        self._max_corner_motion:
+            self._hits += 1
+            rvec, tvec, quality = self._pose
+            return numpy.copy(rvec), numpy.copy(tvec), quality
+        return None
+
+    def set_pose(self, tag_ids, points, pose):
+        """
+        Stores a newly estimated pose, and the tag corners it came from
+
+        :param tag_ids: the ids of the tags seen
+        :param points: an n x 2 array of the tag corners
+        :param pose: a rotation, translation and quality
+        """
+        self._tag_ids = None
+        if len(tag_ids) > 0:
+            self._misses += 1
+            self._tag_ids = tag_ids
+            self._points = points
+            self._pose = (numpy.copy(pose[0]), numpy.copy(pose[1]), pose[2])
+
+    def get_counts(self):
+        """
+        :return: the number of poses reused, and the number estimated
+        """
+        return self._hits, self._misses
 
 
 class ArUcoRigidBody():
@@ -195,6 +403,11 @@ class ArUcoRigidBody():
         self.name = rigid_body_name
         self._default_tags = None
         self._dictionary_name = "Not Set"
+        self._warm_start = False
+        self._max_reprojection_error = 2.0
+        self._last_pose = None
+        self._solver = None
+        self._corner_gate = None
 
     def reset_2d_points(self):
         """
@@ -212,13 +425,25 @@ class ArUcoRigidBody():
 
         :return: tag ids for any assigned tags
         """
-        tags_assigned = []
-        for index, tag_id in enumerate(tag_ids):
-            if tag_id in self._ar_board.ids:
-                self._tags_2d.append_tag(tag_id, two_d_points[index])
-                tags_assigned.append(tag_id)
+        board_rows = self._ar_board.get_rows(tag_ids)
+        detected_rows = numpy.flatnonzero(board_rows >= 0)
+        self.add_2d_points([two_d_points[row] for row in detected_rows],
+                           [tag_ids[row] for row in detected_rows],
+                           board_rows[detected_rows])
         self._default_tags = two_d_points
-        return tags_assigned
+        return [tag_ids[row] for row in detected_rows]
+
+    def add_2d_points(self, two_d_points, tag_ids, board_rows):
+        """
+        Adds tags that are already known to belong to this rigid body
+
+        :param two_d_points: array of marker corners, 4 for each tag
+        :param tag_ids: id for each tag
+        :param board_rows: the row of each tag in the board
+        """
+        for index, tag_id in enumerate(tag_ids):
+            self._tags_2d.append_tag(tag_id, two_d_points[index],
+                                     board_rows[index])
 
     def load_3d_points(self, filename, dictionaryname):
         """
@@ -260,14 +485,126 @@ class ArUcoRigidBody():
             None we estimate pose based on pattern size
         :param: 1x5 camera distortion vector
         """
+        if self._corner_gate is None:
+            return self._estimate_pose(camera_projection_matrix,
+                                       camera_distortion)
+
+        tag_ids = numpy.ravel(self._tags_2d.ids)
+        points = numpy.reshape(self._tags_2d.points, (-1, 2))
+        pose = self._corner_gate.get_pose(tag_ids, points)
+        if pose is None:
+            pose = self._estimate_pose(camera_projection_matrix,
+                                       camera_distortion)
+            self._corner_gate.set_pose(tag_ids, points, pose)
+        return pose
+
+    def _estimate_pose(self, camera_projection_matrix, camera_distortion):
+        """
+        Estimates the pose of the rigid body from the 2D points
+        """
         if camera_projection_matrix is None:
             return estimate_poses_no_calibration(self._tags_2d.points,
                                                  self._ar_board)
 
-        return estimate_poses_with_calibration(
+        board_rows = self._tags_2d.board_rows
+        if None in board_rows:
+            board_rows = None
+        rvec, tvec, quality = estimate_poses_with_calibration(
                         self._tags_2d.points, self._tags_2d.ids,
                             self._ar_board,
-                            camera_projection_matrix, camera_distortion)
+                            camera_projection_matrix, camera_distortion,
+                            pose_guess = self._last_pose,
+                            max_reprojection_error =
+                                self._max_reprojection_error,
+                            solver = self._solver,
+                            board_rows = board_rows)
+
+        if self._warm_start:
+            self._last_pose = None
+            if not numpy.isnan(rvec).any():
+                self._last_pose = (numpy.copy(rvec), numpy.copy(tvec))
+        return rvec, tvec, quality
+
+    def set_max_corner_motion(self, max_corner_motion):
+        """
+        Sets how far, in pixels, the tag corners can move before the
+        pose is estimated again. While the same tags are seen and no
+        corner has moved further than this from where it was when the
+        pose was last estimated, get_pose returns that pose.
+
+        :param max_corner_motion: the largest corner motion in pixels,
+            or None to estimate the pose every time
+        """
+        self._corner_gate = None
+        if max_corner_motion is not None:
+            self._corner_gate = CornerMotionGate(max_corner_motion)
+
+    def get_gate_counts(self):
+        """
+        :return: the number of times get_pose reused the last pose, and
+            the number of times it estimated the pose, when max corner
+            motion is set
+        """
+        if self._corner_gate is None:
+            return 0, 0
+        return self._corner_gate.get_counts()
+
+    def set_pnp_solver(self, solver_name):
+        """
+        Sets the method used to estimate pose when the camera is
+        calibrated. Call this after the 3D points are loaded and scaled.
+
+        :param solver_name: None to use the default methods, one of
+            ITERATIVE, IPPE, IPPE_SQUARE, SQPNP or EPNP, or "auto" to
+            pick the fastest method suited to the tag geometry
+        :raise ValueError: if the method is unknown or does not suit
+            the tag geometry
+        """
+        if solver_name is None:
+            self._solver = None
+            return
+
+        auto_solver = select_pnp_solver(self._ar_board.corner_points)
+        if solver_name == 'auto':
+            self._solver = auto_solver
+            return
+
+        if solver_name not in ['ITERATIVE', 'IPPE', 'IPPE_SQUARE',
+                               'SQPNP', 'EPNP']:
+            raise ValueError(f'Unknown pnp solver {solver_name}')
+        solver = getattr(cv2, 'SOLVEPNP_' + solver_name)
+        if solver == cv2.SOLVEPNP_IPPE_SQUARE and \
+                        auto_solver != cv2.SOLVEPNP_IPPE_SQUARE:
+            raise ValueError('IPPE_SQUARE needs a rigid body made of a '
+                             'single square tag centred on the origin')
+        if solver == cv2.SOLVEPNP_IPPE and auto_solver == cv2.SOLVEPNP_SQPNP:
+            raise ValueError('IPPE needs a planar rigid body')
+        self._solver = solver
+
+    def set_warm_start(self, warm_start, max_reprojection_error = 2.0):
+        """
+        When warm start is on, pose estimation for multi-tag rigid bodies
+        starts from the last valid pose. After a missed frame, or when
+        the result has a large reprojection error, the pose is
+        estimated from scratch.
+
+        :param warm_start: true to turn warm starting on
+        :param max_reprojection_error: the largest root mean square
+            reprojection error (pixels) to accept from a warm start
+        """
+        self._warm_start = warm_start
+        self._max_reprojection_error = max_reprojection_error
+        self._last_pose = None
+
+    def get_corner_points(self):
+        """returns the 3D corners of the markers, an n x 4 x 3 array"""
+
+        return self._ar_board.corner_points
+
+    def get_marker_ids(self):
+        """returns the ids of the markers that make up the rigid body"""
+
+        return self._ar_board.ids
 
     def get_dictionary_name(self):
         """returns the name of the aruco dictionary in use"""
@@ -2,15 +2,31 @@
 
 """A class for straightforward tracking with an ARuCo
 """
-from time import time
-from numpy import array, float32, loadtxt, ravel, float64
+import asyncio
+from itertools import islice
+from time import time, perf_counter
+from os import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from numpy import array, float32, loadtxt, flatnonzero, float64, zeros, \
+                full, nan, isnan, reshape, array_split, concatenate, \
+                ravel, identity
 from cv2 import aruco
 import cv2
 from imshowtk.imshowtk import ImshowTk as Debugger
 
 from sksurgerycore.baseclasses.tracker import SKSBaseTracker
+from sksurgerycore.algorithms.tracking_smoothing import quaternion_to_matrix
 from sksurgeryarucotracker.algorithms.rigid_bodies import ArUcoRigidBody, \
-                configure_rigid_bodies
+                MarkerIndex, SingleTagCache, configure_rigid_bodies
+from sksurgeryarucotracker.algorithms.detection import MarkerDetector, \
+                RegionOfInterestDetector, CornerFlowTracker, PyramidDetector, \
+                TiledDetector, MotionGate, undistort_detections, \
+                detector_parameters
+from sksurgeryarucotracker.algorithms.registration_2d3d import \
+                estimate_single_tag_poses, tracking_matrices
+from sksurgeryarucotracker.algorithms.latency import LatencyController
+from sksurgeryarucotracker.capture import ThreadedCapture, \
+                DrainingCapture, FramePool
 
 def _load_calibration(textfile):
     """
@@ -21,7 +37,55 @@ def _load_calibration(textfile):
 
     return projection_matrix, distortion
 
+STREAM_DROP_POLICIES = ('drop oldest', 'drop newest', 'block')
+
+
+def _make_capture(configuration):
+    """
+    :return: the video capture the configuration asks for
+    :raise ValueError: if threaded capture and drain stale frames are
+        both set
+    """
+    if configuration.get("threaded capture", False):
+        if configuration.get("drain stale frames", False):
+            raise ValueError('Threaded capture and drain stale '
+                             'frames can not be used together')
+        return ThreadedCapture()
+    if configuration.get("drain stale frames", False):
+        return DrainingCapture(configuration.get("max drained frames", 10))
+    return cv2.VideoCapture()
+
+
+class EndOfStream(ValueError):
+    """
+    Raised when a frame is asked for from the video source, and the
+    video source has no more frames.
+    """
+
+
+class TrackingArrays():
+    """
+    Tracking results for one frame, held as NumPy arrays with one row
+    per tool. Arrays are allocated with space for capacity tools, of
+    which the first count are in use. reused is True when the tracking
+    was reused from an earlier frame by the motion gate.
+    """
+    def __init__(self, capacity):
+        """
+        :param capacity: the number of tools to allocate space for
+        """
+        self.capacity = capacity
+        self.count = 0
+        self.tool_handles = zeros(capacity, dtype = int)
+        self.tracking = full((capacity, 4, 4), nan, dtype = float64)
+        self.quality = zeros(capacity, dtype = float64)
+        self.timestamp = nan
+        self.frame_number = -1
+        self.reused = False
+
+
 class ArUcoTracker(SKSBaseTracker):
+    # pylint: disable=too-many-instance-attributes
     """
         Initialises and Configures the ArUco detector
 
@@ -29,6 +93,26 @@ class ArUcoTracker(SKSBaseTracker):
 
             video source: defaults to 0
 
+            threaded capture: if true frames are read from the video source
+            on a background thread and get_frame uses the newest frame,
+            defaults to False
+
+            drain stale frames: if true each read discards the frames
+            queued by a live video source and uses the newest, defaults
+            to False. Not for use with video files, which never block,
+            or with threaded capture
+
+            max drained frames: the most queued frames discarded per read
+            when draining stale frames, defaults to 10
+
+            With threaded capture or drain stale frames the timestamp
+            returned by get_frame is the time the frame was grabbed,
+            otherwise it is the time get_frame was called
+
+            frame buffers: the number of buffers frames are read from the
+            video source into, reused in turn rather than allocating an
+            array for every frame, defaults to 2
+
             aruco dictionary: defaults to DICT_4X4_50
 
             marker size: defaults to 50 mm
@@ -37,6 +121,10 @@ class ArUcoTracker(SKSBaseTracker):
 
             camera distortion: defaults to None
 
+            undistort corners: if true, lens distortion is removed from all
+            detected marker corners in one step per frame, and pose
+            estimation is done without distortion, defaults to False
+
             smoothing buffer: specify a buffer over which to average the
             tracking, defaults to 1
 
@@ -44,7 +132,90 @@ class ArUcoTracker(SKSBaseTracker):
             have a 'name', a 'filename' where the tag geometry is defined,
             and an 'aruco dictionary' to use. Additionally we can include
             'tag width' in mm when the tag has been scaled during printing or
-            is displayed on a mobile phone screen or similar
+            is displayed on a mobile phone screen or similar. Setting
+            'warm start' to True starts each frame's pose estimation from
+            the previous pose, falling back to a full solve when the
+            reprojection error exceeds 'max reprojection error' pixels
+            (default 2.0). 'pnp solver' may be one of ITERATIVE, IPPE,
+            IPPE_SQUARE, SQPNP, EPNP, or auto to pick the fastest method
+            suited to the tag geometry. When 'max corner motion' is set,
+            the pose is only estimated again once a tag corner has moved
+            more than that many pixels, see get_gate_counts
+
+            single tag cache size: the number of rigid bodies for tags
+            without a rigid body definition to keep between frames,
+            defaults to 256
+
+            detector preset: one of fast, balanced (OpenCV's defaults)
+            or accurate, setting the aruco detector parameters. Defaults
+            to None, OpenCV's defaults
+
+            detector parameters: a dictionary of aruco DetectorParameters
+            names and values, set on top of the preset. For example
+            adaptiveThreshWinSizeMin, adaptiveThreshWinSizeMax,
+            adaptiveThreshWinSizeStep, cornerRefinementMethod (by name, as
+            CORNER_REFINE_SUBPIX), minMarkerPerimeterRate,
+            maxMarkerPerimeterRate or polygonalApproxAccuracyRate
+
+            single pass detection: if true and more than one aruco
+            dictionary is in use, marker candidates are found once per
+            frame and identified against every dictionary, defaults to True
+
+            worker threads: the number of threads to use to detect each
+            dictionary at the same time, and to estimate the poses of
+            rigid bodies at the same time. Results are the same, and
+            in the same order, as without threads. Defaults to None, all
+            work is done on the calling thread
+
+            detection tiles: a list of the number of columns and rows of
+            tiles to split each frame into. Tiles are searched at the same
+            time on 'worker threads' threads, which defaults to the number
+            of processors when tiling. Neighbouring tiles overlap by 'tile
+            overlap' pixels (default 128), which should be more than the
+            size of the largest marker. Defaults to None, no tiling
+
+            detection scale: markers are found in a copy of the frame
+            resized by this factor, and their corners then refined in the
+            full resolution frame. Either a number greater than 0 and no
+            more than 1, or auto to pick the scale from the size of the
+            markers in the previous frame, defaults to 1
+
+            roi detection: if true, markers are only searched for in
+            regions around where they were seen, or predicted from
+            the tools' poses, in the previous frame. The whole frame is
+            searched every 'roi full scan interval' frames (default 30)
+            or when a tool is lost. 'roi padding' sets the padding around
+            each region as a fraction of its size, defaults to 0.5
+
+            optical flow: if true, markers are detected every 'detection
+            interval' frames (default 5), and followed with optical flow
+            in between. If any marker's corners fail a forward-backward
+            check against 'max flow error' pixels (default 1.0) the
+            markers are detected again straight away
+
+            motion gate: if true, frames that differ from the last fully
+            processed frame by less than 'motion threshold' (default 2.0)
+            grey levels on average, measured on a heavily downsampled
+            copy, are not searched for markers. The previous frame's
+            tracking is returned instead, see frame_reused. At least
+            every 'motion gate interval' frames (default 30) are
+            processed in full. Defaults to False
+
+            latency budget: a target time in seconds to process each
+            frame, from when it is read to when tracking is returned. If
+            set, the tracker degrades in steps to stay within the budget,
+            first limiting detection to regions of interest, then
+            detecting at reduced scale, then skipping frames and reusing
+            the last result, see get_latency_level. Defaults to None
+
+            stream queue size: the most tracking results stream holds
+            waiting for the consumer, defaults to 2
+
+            stream drop policy: what stream does with a new result when
+            its queue is full. 'drop oldest' discards the oldest queued
+            result, 'drop newest' discards the new result, and 'block'
+            stops capturing until the consumer catches up. Defaults to
+            'drop oldest'
 
         :raise Exception: ImportError, ValueError
         """
@@ -59,6 +230,8 @@ class ArUcoTracker(SKSBaseTracker):
         self._state = None
 
         self._frame_number = 0
+        self._tool_handles = {}
+        self._tool_names = []
 
         self._debug = Debugger(configuration.get("debug", False),
                 configuration.get("debug subsample", 4))
@@ -66,21 +239,41 @@ class ArUcoTracker(SKSBaseTracker):
         video_source = configuration.get("video source", 0)
 
         if video_source != 'none':
-            self._capture = cv2.VideoCapture()
+            self._capture = _make_capture(configuration)
+            self._frame_pool = FramePool(
+                            configuration.get("frame buffers", 2))
         else:
             self._capture = None
+            self._frame_pool = None
 
         self._ar_dicts, self._ar_dict_names, self._rigid_bodies = \
                         configure_rigid_bodies(configuration)
+        for rigid_body in self._rigid_bodies:
+            self._get_tool_handle(rigid_body.name)
+        self._configure_detection(configuration)
 
         super().__init__(configuration, self._rigid_bodies)
         self._marker_size = configuration.get("marker size", 50)
+        self._single_tags = SingleTagCache(self._marker_size,
+                        configuration.get("single tag cache size", 256))
 
         if "calibration" in configuration:
             self._camera_projection_matrix, self._camera_distortion = \
                 _load_calibration(configuration.get("calibration"))
 
         self._check_pose_estimation_ok()
+        self._undistort_corners = configuration.get("undistort corners",
+                                                    False)
+
+        self._stream_queue_size = configuration.get("stream queue size", 2)
+        self._stream_drop_policy = configuration.get("stream drop policy",
+                                                     "drop oldest")
+        if self._stream_drop_policy not in STREAM_DROP_POLICIES:
+            raise ValueError('Stream drop policy must be one of '
+                             f'{STREAM_DROP_POLICIES}, not '
+                             f'{self._stream_drop_policy}')
+        self._async_executor = None
+        self._frames_dropped = 0
 
         if video_source != 'none':
             if self._capture.open(video_source):
@@ -99,6 +292,62 @@ class ArUcoTracker(SKSBaseTracker):
             self._state = "ready"
 
 
+    def _configure_detection(self, configuration):
+        """Sets up marker detection and the assignment of markers
+        to rigid bodies"""
+        self._marker_index = MarkerIndex(self._ar_dict_names,
+                                         self._rigid_bodies)
+        self._worker_threads = configuration.get("worker threads", None)
+        tiles = configuration.get("detection tiles", None)
+        if tiles is not None and self._worker_threads is None:
+            self._worker_threads = cpu_count()
+        self._executor = None
+        if self._worker_threads is not None:
+            self._executor = ThreadPoolExecutor(self._worker_threads)
+
+        self._detector = MarkerDetector(self._ar_dicts,
+                        configuration.get("single pass detection", True),
+                        detector_parameters(
+                            configuration.get("detector preset", None),
+                            configuration.get("detector parameters", None)),
+                        self._executor)
+        if tiles is not None:
+            self._detector = TiledDetector(self._detector, self._executor,
+                            tiles, configuration.get("tile overlap", 128))
+        self._latency_controller = None
+        if configuration.get("latency budget", None) is not None:
+            self._latency_controller = LatencyController(
+                            configuration.get("latency budget"))
+
+        self._detection_scale = configuration.get("detection scale", 1.0)
+        self._pyramid_detector = None
+        if self._detection_scale != 1.0 or \
+                        self._latency_controller is not None:
+            self._pyramid_detector = PyramidDetector(self._detector,
+                                                     self._detection_scale)
+            self._detector = self._pyramid_detector
+        self._roi_configured = configuration.get("roi detection", False)
+        self._use_roi = self._roi_configured
+        self._roi_detector = None
+        if self._roi_configured or self._latency_controller is not None:
+            self._roi_detector = RegionOfInterestDetector(self._detector,
+                        configuration.get("roi full scan interval", 30),
+                        configuration.get("roi padding", 0.5))
+        self._predicted_points = []
+        self._visible_tools = set()
+        self._motion_gate = None
+        if configuration.get("motion gate", False):
+            self._motion_gate = MotionGate(
+                        configuration.get("motion threshold", 2.0),
+                        configuration.get("motion gate interval", 30) - 1)
+        self._last_result = None
+        self._frame_reused = False
+        self._flow_tracker = None
+        if configuration.get("optical flow", False):
+            self._flow_tracker = CornerFlowTracker(
+                        configuration.get("detection interval", 5),
+                        configuration.get("max flow error", 1.0))
+
     def _check_pose_estimation_ok(self):
         """Checks that the camera projection matrix and camera distortion
         matrices can be used to estimate pose"""
@@ -124,6 +373,11 @@ class ArUcoTracker(SKSBaseTracker):
         if self._capture is not None:
             self._capture.release()
             del self._capture
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._async_executor is not None:
+            self._async_executor.shutdown()
+            self._async_executor = None
         self._state = None
 
     def get_frame(self, frame=None):
@@ -147,30 +401,377 @@ class ArUcoTracker(SKSBaseTracker):
 
         :raise Exception: ValueError
         """
+        port_handles, timestamp, tracking_rots, tracking_trans, quality = \
+                        self._track_frame(frame)
+
+        self.add_frame_to_buffer(port_handles,
+                    [timestamp] * len(port_handles),
+                    [self._frame_number] * len(port_handles),
+                    tracking_rots, tracking_trans, quality,
+                    rot_is_quaternion = False)
+
+        self._frame_number += 1
+        return self.get_smooth_frame(port_handles)
+
+    async def get_frame_async(self, frame=None):
+        """Gets a frame of tracking data, as get_frame, without blocking
+        the event loop. Capture and detection run on a thread of their
+        own, one frame at a time.
+
+        :param frame: an image to process, if None, we use the OpenCV
+            video source.
+        :return: as get_frame
+        :raise Exception: ValueError
+        """
+        if self._async_executor is None:
+            self._async_executor = ThreadPoolExecutor(max_workers = 1)
+        return await asyncio.get_running_loop().run_in_executor(
+                        self._async_executor, self.get_frame, frame)
+
+    async def stream(self):
+        """Tracks frames from the video source continuously, off the
+        event loop, for use as async for tracking in tracker.stream().
+        Frames are captured and tracked while the consumer is busy, so
+        results wait in a queue of 'stream queue size' results, and the
+        'stream drop policy' decides what happens when it is full.
+
+        The stream ends when the video source runs out of frames or
+        tracking is stopped.
+
+        :return: an asynchronous iterator of tracking results, each as
+            returned by get_frame
+        :raise Exception: ValueError
+        """
+        if self._capture is None:
+            raise ValueError('Attempted to stream, with no video source')
+        queue = asyncio.Queue(self._stream_queue_size)
+        producer = asyncio.create_task(self._produce(queue))
+        try:
+            while True:
+                result, error = await queue.get()
+                if error is not None:
+                    raise error
+                if result is None:
+                    return
+                yield result
+        finally:
+            producer.cancel()
+            #wait for any frame still being tracked, so the tracker is
+            #free for use once the stream is closed
+            if self._async_executor is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                                self._async_executor, lambda: None)
+
+    async def _produce(self, queue):
+        """
+        Puts tracking results on a queue for stream, following the drop
+        policy, then (None, None) when the video source is exhausted or
+        tracking is stopped, or (None, error) if tracking fails.
+        """
+        try:
+            while self._state == "tracking":
+                try:
+                    result = await self.get_frame_async()
+                except EndOfStream:
+                    break
+                if queue.full() and self._stream_drop_policy != 'block':
+                    self._frames_dropped += 1
+                    if self._stream_drop_policy == 'drop newest':
+                        continue
+                    queue.get_nowait()
+                await queue.put((result, None))
+        except Exception as error: # pylint: disable=broad-except
+            await queue.put((None, error))
+            return
+        await queue.put((None, None))
+
+    def get_frames_dropped(self):
+        """
+        :return: the number of tracking results stream has dropped
+            because the consumer did not keep up
+        """
+        return self._frames_dropped
+
+    def iter_frames(self, source=None, start=0, stop=None, step=1):
+        """Tracks a sequence of frames, reading each frame only when it
+        is needed, so whole videos are never held in memory.
+
+        :param source: an iterable of images to track, if None, we use
+            the OpenCV video source, which is released when iteration
+            finishes or the generator is closed. Threaded capture and
+            drain stale frames skip frames of their own accord, so can
+            not be used
+        :param start: the index of the first frame to track
+        :param stop: the index to stop before, or None to track to the
+            end of the source
+        :param step: track every step'th frame. Frames stepped over in
+            the video source are grabbed but not decoded
+        :return: a generator of (frame index, tracking), where frame
+            index counts frames from the start of the source and
+            tracking is as returned by get_frame
+        :raise Exception: ValueError
+        """
+        if start < 0 or step < 1 or (stop is not None and stop < 0):
+            raise ValueError('Frame range needs start and stop not '
+                             'negative, and step positive')
+        if source is None:
+            if self._capture is None:
+                raise ValueError('No frame source, and no video source')
+            if isinstance(self._capture, (ThreadedCapture, DrainingCapture)):
+                raise ValueError('Can not iterate over frames with threaded '
+                                 'capture or drain stale frames')
+            frames = self._capture_frames(start, stop, step)
+        else:
+            frames = ((start + step * count, frame) for count, frame in
+                      enumerate(islice(source, start, stop, step)))
+
+        try:
+            for frame_index, frame in frames:
+                yield frame_index, self.get_frame(frame)
+        finally:
+            frames.close()
+
+    def _capture_frames(self, start, stop, step):
+        """
+        Reads frames from the video source for iter_frames, seeking to
+        the first where the source allows it, and grabbing without
+        decoding the frames stepped over.
+
+        :return: a generator of (frame index, frame)
+        """
+        try:
+            frame_index = 0
+            if start > 0 and self._capture.set(cv2.CAP_PROP_POS_FRAMES,
+                                               start):
+                frame_index = start
+            while stop is None or frame_index < stop:
+                if frame_index < start or (frame_index - start) % step:
+                    if not self._capture.grab():
+                        return
+                    frame_index += 1
+                    continue
+                success, frame = self._frame_pool.read(self._capture)
+                if not success:
+                    return
+                yield frame_index, frame
+                frame_index += 1
+        finally:
+            self._capture.release()
+
+    def get_frame_arrays(self, frame=None, out=None):
+        """Gets a frame of tracking data from the Tracker device, as
+        NumPy arrays rather than lists.
+
+        :param frame: an image to process, if None, we use the OpenCV
+            video source.
+        :param out: an optional TrackingArrays to write the results into,
+            which must have space for every tool in the frame.
+        :return: a TrackingArrays holding an integer tool handle, a 4x4
+            tracking matrix and a quality for each tool, plus the
+            timestamp and frame number. Tool handles index the list
+            returned by get_tool_names. Tracking is given as 4x4
+            matrices even when use quaternions is set.
+
+        :raise Exception: ValueError
+        """
+        port_handles, timestamp, tracking_rots, tracking_trans, quality = \
+                        self._track_frame(frame)
+        tool_count = len(port_handles)
+
+        if out is None:
+            out = TrackingArrays(tool_count)
+        if out.capacity < tool_count:
+            raise ValueError(f'TrackingArrays has space for {out.capacity} '
+                             f'tools, but {tool_count} were tracked')
+
+        for index, port_handle in enumerate(port_handles):
+            out.tool_handles[index] = self._get_tool_handle(port_handle)
+
+        if self.buffer_size == 1:
+            tracking_matrices(tracking_rots, tracking_trans,
+                              out.tracking[:tool_count])
+            out.quality[:tool_count] = quality
+        else:
+            self.add_frame_to_buffer(port_handles,
+                    [timestamp] * tool_count,
+                    [self._frame_number] * tool_count,
+                    tracking_rots, tracking_trans, quality,
+                    rot_is_quaternion = False)
+            smoothed = self.get_smooth_frame(port_handles)
+            for index in range(tool_count):
+                if self.use_quaternions:
+                    quaternion = ravel(smoothed[3][index])
+                    out.tracking[index] = identity(4)
+                    out.tracking[index, 0:3, 0:3] = \
+                                    quaternion_to_matrix(quaternion[0:4])
+                    out.tracking[index, 0:3, 3] = quaternion[4:7]
+                else:
+                    out.tracking[index] = smoothed[3][index]
+            out.quality[:tool_count] = smoothed[4]
+
+        out.count = tool_count
+        out.timestamp = timestamp
+        out.frame_number = self._frame_number
+        out.reused = self._frame_reused
+        self._frame_number += 1
+        return out
+
+    def frame_reused(self):
+        """
+        :return: True if the tracking returned for the last frame was
+            reused from an earlier frame, because the motion gate found
+            the image had not changed
+        """
+        return self._frame_reused
+
+    def get_gate_counts(self):
+        """
+        :return: a dictionary giving, for each rigid body, the number
+            of frames where the last pose was reused and the number where
+            the pose was estimated, both zero unless the rigid body has
+            a max corner motion
+        """
+        return {rigid_body.name : rigid_body.get_gate_counts()
+                for rigid_body in self._rigid_bodies}
+
+    def get_tool_names(self):
+        """
+        :return: the names of the tools seen by get_frame_arrays, indexed
+            by tool handle
+        """
+        return list(self._tool_names)
+
+    def _get_tool_handle(self, port_handle):
+        """
+        :return: the integer tool handle for a port handle, assigning
+            a new one if the port handle has not been seen before
+        """
+        if port_handle not in self._tool_handles:
+            self._tool_handles[port_handle] = len(self._tool_names)
+            self._tool_names.append(port_handle)
+        return self._tool_handles[port_handle]
+
+    def _track_frame(self, frame):
+        """
+        Detects markers and estimates the pose of every tool in a frame.
+
+        :param frame: an image to process, if None, we use the OpenCV
+            video source.
+        :return: port handles, a timestamp, and lists of rotations,
+            translations and qualities, one per tool
+        :raise Exception: ValueError
+        """
         if self._state != "tracking":
             raise ValueError('Attempted to get frame, when not tracking')
 
-        if self._capture is not None:
-            _, frame = self._capture.read()
+        timestamp = time()
+        if frame is None and self._capture is not None:
+            _, frame = self._frame_pool.read(self._capture)
+            if frame is None:
+                raise EndOfStream('Frame not set, and capture.read failed')
+            if hasattr(self._capture, 'get_grab_time'):
+                timestamp = self._capture.get_grab_time()
 
         if frame is None:
             raise ValueError('Frame not set, and capture.read failed')
+        start = perf_counter()
+        self._frame_reused = self._skip_frame(frame) and \
+                        self._last_result is not None
+        if self._frame_reused:
+            port_handles, tracking_rots, tracking_trans, quality = \
+                            self._last_result
+            return (list(port_handles), timestamp, list(tracking_rots),
+                    list(tracking_trans), list(quality))
 
-        port_handles = []
-        time_stamps = []
-        frame_numbers = []
-        tracking_rots = []
-        tracking_trans = []
-        quality = []
         self._reset_rigid_bodies()
 
-        timestamp = time()
+        detections = self._detect_markers(frame)
+        raw_detections = detections
+        camera_distortion = self._camera_distortion
+        if self._undistort_corners and \
+                        self._camera_projection_matrix is not None:
+            detections = undistort_detections(detections,
+                            self._camera_projection_matrix,
+                            self._camera_distortion)
+            camera_distortion = zeros(5, dtype = float32)
+
+        temporary_rigid_bodies, temporary_corners = \
+                        self._assign_markers(frame, detections)
+
+        poses = self._map(lambda rigid_body: rigid_body.get_pose(
+                                self._camera_projection_matrix,
+                                camera_distortion),
+                          self._rigid_bodies)
+        poses.extend(self._get_single_tag_poses(temporary_rigid_bodies,
+                                    temporary_corners, camera_distortion))
+
+        if self._roi_detector is not None:
+            self._predicted_points = self._predict_marker_points(
+                            raw_detections, poses)
+
+        port_handles = [rigid_body.name for rigid_body in
+                        self._rigid_bodies + temporary_rigid_bodies]
+        tracking_rots = [pose[0] for pose in poses]
+        tracking_trans = [pose[1] for pose in poses]
+        quality = [pose[2] for pose in poses]
+        if self._motion_gate is not None or \
+                        self._latency_controller is not None:
+            self._last_result = (port_handles, tracking_rots, tracking_trans,
+                                 quality)
+        if self._latency_controller is not None and \
+                self._latency_controller.update(perf_counter() - start):
+            self._apply_latency_level()
+        return port_handles, timestamp, tracking_rots, tracking_trans, quality
+
+    def _skip_frame(self, frame):
+        """
+        :return: True if the frame need not be processed, because the
+            latency controller is skipping frames or the motion gate
+            finds the frame unchanged
+        """
+        if self._latency_controller is not None and \
+                        self._latency_controller.skip_frame():
+            return True
+        return self._motion_gate is not None and \
+                        self._motion_gate.is_static(frame)
+
+    def _apply_latency_level(self):
+        """
+        Sets up detection for the latency controller's current level
+        """
+        use_roi, max_scale, _ = self._latency_controller.get_settings()
+        self._use_roi = self._roi_configured or use_roi
+        scale = self._detection_scale
+        if max_scale < 1.0:
+            scale = max_scale
+            if self._detection_scale != 'auto':
+                scale = min(self._detection_scale, max_scale)
+        self._pyramid_detector.set_scale(scale)
+
+    def get_latency_level(self):
+        """
+        :return: the level the latency controller is running at, 0 when
+            running as configured or when there is no latency budget
+        """
+        if self._latency_controller is None:
+            return 0
+        return self._latency_controller.get_level()
 
+    def _assign_markers(self, frame, detections):
+        """
+        Gives the detected markers to the rigid bodies they belong to,
+        and makes a single tag rigid body for each of the rest.
 
+        :param frame: the image, for debug display
+        :param detections: detections, as returned by MarkerDetector.detect
+        :return: a list of single tag rigid bodies, and a list of the
+            marker corners for each
+        """
         temporary_rigid_bodies = []
+        temporary_corners = []
+        temporary_keys = set()
         for dict_index, ar_dict in enumerate(self._ar_dicts):
-            marker_corners, marker_ids, _ = \
-                    aruco.detectMarkers(frame, ar_dict)
+            marker_corners, marker_ids = detections[dict_index]
             if not marker_corners:
                 self._debug.imshow(frame)
                 continue
@@ -179,43 +780,137 @@ class ArUcoTracker(SKSBaseTracker):
                 aruco.drawDetectedMarkers(frame, marker_corners)
                 self._debug.imshow(frame)
 
-            assigned_marker_ids = []
-            for rigid_body in self._rigid_bodies:
-                if rigid_body.get_dictionary_name() == \
-                                self._ar_dict_names[dict_index]:
-                    assigned_marker_ids.extend(rigid_body.set_2d_points(
-                                    marker_corners, marker_ids))
+            unassigned = self._marker_index.assign(dict_index,
+                            marker_corners, marker_ids)
 
-            #find any unassigned tags and create a rigid body for them
-            for index, marker_id in enumerate(marker_ids):
-                if marker_id[0] not in ravel(assigned_marker_ids):
+            #create a rigid body for any unassigned tags
+            for index in flatnonzero(unassigned):
+                marker_id = marker_ids[index]
+                key = (dict_index, marker_id[0])
+                if key in temporary_keys:
+                    #the same tag seen twice, don't reuse the cached body
                     temp_rigid_body = ArUcoRigidBody(
                                     str(self._ar_dict_names[dict_index]) +
                                     ":" + str(marker_id[0]))
                     temp_rigid_body.add_single_tag(self._marker_size,
                                     marker_id[0], ar_dict)
-                    temp_rigid_body.set_2d_points([marker_corners[index]],
-                                    marker_id)
-                    temporary_rigid_bodies.append(temp_rigid_body)
-
-        for rigid_body in self._rigid_bodies + temporary_rigid_bodies:
-            rb_rot, rb_trans, rbquality = rigid_body.get_pose(
-                             self._camera_projection_matrix,
-                             self._camera_distortion)
-            port_handles.append(rigid_body.name)
-            time_stamps.append(timestamp)
-            frame_numbers.append(self._frame_number)
-            tracking_rots.append(rb_rot)
-            tracking_trans.append(rb_trans)
-            quality.append(rbquality)
-
-        self.add_frame_to_buffer(port_handles, time_stamps,
-                    frame_numbers,
-                    tracking_rots, tracking_trans, quality,
-                    rot_is_quaternion = False)
+                else:
+                    temp_rigid_body = self._single_tags.get(
+                                    self._ar_dict_names[dict_index],
+                                    marker_id[0], ar_dict)
+                    temporary_keys.add(key)
+                temp_rigid_body.set_2d_points([marker_corners[index]],
+                                marker_id)
+                temporary_rigid_bodies.append(temp_rigid_body)
+                temporary_corners.append(marker_corners[index])
+        return temporary_rigid_bodies, temporary_corners
+
+    def _detect_markers(self, frame):
+        """
+        Detects markers, or follows them from the previous frame with
+        optical flow when that is on. Detection is limited to regions
+        around the previous frame's markers when roi detection is on.
+        If that loses sight of any tool the whole frame is searched.
 
-        self._frame_number += 1
-        return self.get_smooth_frame(port_handles)
+        :return: detections, as returned by MarkerDetector.detect
+        """
+        if self._flow_tracker is None:
+            return self._search_frame(frame)
+
+        detections = self._flow_tracker.track(frame)
+        if detections is None:
+            detections = self._search_frame(frame)
+            self._flow_tracker.set_detections(frame, detections)
+        return detections
+
+    def _search_frame(self, frame):
+        """
+        Searches a frame for markers, using roi detection if it is on.
+
+        :return: detections, as returned by MarkerDetector.detect
+        """
+        if not self._use_roi:
+            return self._detector.detect(frame)
+
+        detections = self._roi_detector.detect(frame, self._predicted_points)
+        visible_tools = self._marker_index.visible_tools(detections)
+        if not self._roi_detector.last_scan_was_full and \
+                        not visible_tools >= self._visible_tools:
+            detections = self._roi_detector.detect_full(frame)
+            visible_tools = self._marker_index.visible_tools(detections)
+        self._visible_tools = visible_tools
+        return detections
+
+    def _predict_marker_points(self, detections, poses):
+        """
+        Predicts where markers will be in the next frame, from the
+        detected marker corners and, with a calibrated camera, the
+        projected markers of each rigid body.
+
+        :param detections: detections, as returned by MarkerDetector.detect
+        :param poses: rotations, translations and qualities for each of
+            the configured rigid bodies
+        :return: a list of n x 2 arrays of image points
+        """
+        point_sets = [reshape(corners, (-1, 2))
+                      for marker_corners, _ in detections
+                      for corners in marker_corners]
+        if self._camera_projection_matrix is None:
+            return point_sets
+
+        for rigid_body, (rvec, tvec, _) in zip(self._rigid_bodies, poses):
+            if isnan(rvec).any() or isnan(tvec).any():
+                continue
+            projected, _ = cv2.projectPoints(
+                            reshape(rigid_body.get_corner_points(), (-1, 3)),
+                            reshape(rvec, 3).astype(float64),
+                            reshape(tvec, 3).astype(float64),
+                            self._camera_projection_matrix,
+                            self._camera_distortion)
+            point_sets.append(reshape(projected, (-1, 2)))
+        return point_sets
+
+    def _get_single_tag_poses(self, rigid_bodies, marker_corners,
+                              camera_distortion):
+        """
+        Estimates the poses of the single tag rigid bodies created for
+        tags without a rigid body definition. With a calibrated camera
+        all the tags are handled in one batch, or split between the
+        worker threads if there are any.
+
+        :param rigid_bodies: the single tag rigid bodies
+        :param marker_corners: the corners of each tag
+        :param camera_distortion: the camera distortion to use
+        :return: a list of rotations, translations and qualities
+        """
+        if self._camera_projection_matrix is None or not rigid_bodies:
+            return [rigid_body.get_pose(self._camera_projection_matrix,
+                                        camera_distortion)
+                    for rigid_body in rigid_bodies]
+
+        chunks = [reshape(marker_corners, (-1, 4, 2))]
+        if self._executor is not None:
+            chunks = array_split(chunks[0],
+                            min(self._worker_threads, len(rigid_bodies)))
+        results = self._map(lambda corners: estimate_single_tag_poses(
+                                corners, self._marker_size,
+                                self._camera_projection_matrix,
+                                camera_distortion),
+                            chunks)
+        rvecs = concatenate([rvecs for rvecs, _ in results])
+        tvecs = concatenate([tvecs for _, tvecs in results])
+        return [(rvecs[index:index+1], tvecs[index], 1.0)
+                for index in range(len(rigid_bodies))]
+
+    def _map(self, function, items):
+        """
+        Applies function to each item, on the worker threads if
+        there are any
+        :return: a list of the results, in the order of items
+        """
+        if self._executor is None:
+            return [function(item) for item in items]
+        return list(self._executor.map(function, items))
 
     def get_tool_descriptions(self):
         """ Returns tool descriptions """
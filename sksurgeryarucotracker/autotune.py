@@ -0,0 +1,189 @@
+#  -*- coding: utf-8 -*-
+
+"""Tunes the ArUco detector parameters against recorded video"""
+
+import argparse
+import json
+from itertools import product
+from time import perf_counter
+from collections import Counter
+import numpy
+import cv2
+
+from sksurgeryarucotracker.algorithms.rigid_bodies import \
+                configure_rigid_bodies
+from sksurgeryarucotracker.algorithms.detection import MarkerDetector, \
+                PyramidDetector, detector_parameters
+
+
+def default_search_space():
+    """
+    :return: a list of candidate settings, each a dictionary of tracker
+        configuration keys, covering adaptive threshold windows,
+        polygonal approximation accuracy, corner refinement and
+        detection scale
+    """
+    windows = [(3, 23, 10), (13, 13, 10), (7, 23, 16), (5, 15, 5)]
+    approximations = [0.03, 0.05]
+    refinements = ['CORNER_REFINE_NONE', 'CORNER_REFINE_SUBPIX']
+    scales = [1.0, 0.75, 0.5]
+    return [{'detector parameters' : {
+                    'adaptiveThreshWinSizeMin' : window[0],
+                    'adaptiveThreshWinSizeMax' : window[1],
+                    'adaptiveThreshWinSizeStep' : window[2],
+                    'polygonalApproxAccuracyRate' : approximation,
+                    'cornerRefinementMethod' : refinement},
+             'detection scale' : scale}
+            for window, approximation, refinement, scale in
+            product(windows, approximations, refinements, scales)]
+
+
+def read_frames(video, max_frames = None):
+    """
+    Reads frames from a video file.
+
+    :param video: the path to the video
+    :param max_frames: the most frames to read, or None for all
+    :return: a list of frames
+    :raise OSError: if no frames can be read
+    """
+    capture = cv2.VideoCapture(video)
+    frames = []
+    while max_frames is None or len(frames) < max_frames:
+        success, frame = capture.read()
+        if not success:
+            break
+        frames.append(frame)
+    capture.release()
+    if not frames:
+        raise OSError(f'Failed to read any frames from {video}')
+    return frames
+
+
+def _make_detector(ar_dicts, configuration):
+    """
+    Makes a marker detector the way ArUcoTracker does, from the
+    detection keys of a tracker configuration
+    """
+    detector = MarkerDetector(ar_dicts,
+                    configuration.get("single pass detection", True),
+                    detector_parameters(
+                        configuration.get("detector preset", None),
+                        configuration.get("detector parameters", None)))
+    if configuration.get("detection scale", 1.0) != 1.0:
+        detector = PyramidDetector(detector,
+                                   configuration.get("detection scale"))
+    return detector
+
+
+def _marker_counts(detections):
+    """
+    :return: a Counter of (dictionary index, marker id) for detections
+    """
+    return Counter((dict_index, int(marker_id))
+                   for dict_index, (_, marker_ids) in enumerate(detections)
+                   if marker_ids is not None
+                   for marker_id in numpy.ravel(marker_ids))
+
+
+def evaluate(frames, ar_dicts, configuration, baseline):
+    """
+    Runs detection with one set of settings over some frames.
+
+    :param frames: a list of frames
+    :param ar_dicts: the aruco dictionaries to detect
+    :param configuration: tracker configuration keys for detection
+    :param baseline: a list of Counters of the markers to find in each
+        frame, as found by the most thorough settings
+    :return: the recall against the baseline, and the mean and 99th
+        percentile time to detect a frame, in seconds
+    """
+    detector = _make_detector(ar_dicts, configuration)
+    detector.detect(frames[0])
+    found = 0
+    times = []
+    for frame, expected in zip(frames, baseline):
+        start = perf_counter()
+        detections = detector.detect(frame)
+        times.append(perf_counter() - start)
+        found += sum((_marker_counts(detections) & expected).values())
+
+    expected_count = sum(sum(expected.values()) for expected in baseline)
+    return (found / expected_count, float(numpy.mean(times)),
+            float(numpy.percentile(times, 99)))
+
+
+def pareto_front(results):
+    """
+    Finds the results that no other result beats on recall, mean time
+    and 99th percentile time together.
+
+    :param results: a list of (recall, mean time, p99 time, settings)
+    :return: the Pareto optimal results, fastest first
+    """
+    front = []
+    for result in results:
+        dominated = any(other[0] >= result[0] and other[1] <= result[1] and
+                        other[2] <= result[2] and other[0:3] != result[0:3]
+                        for other in results)
+        if not dominated:
+            front.append(result)
+    return sorted(front, key = lambda result: result[1:3])
+
+
+def autotune(frames, configuration, search_space = None):
+    """
+    Measures each candidate setting against a baseline detection with
+    the accurate preset at full scale.
+
+    :param frames: a list of frames
+    :param configuration: a tracker configuration, giving the aruco
+        dictionaries to detect
+    :param search_space: a list of candidate settings, each a dictionary
+        of tracker configuration keys, defaults to default_search_space
+    :return: a list of (recall, mean time, p99 time, settings), one per
+        candidate
+    :raise ValueError: if the baseline finds no markers
+    """
+    if search_space is None:
+        search_space = default_search_space()
+    ar_dicts, _, _ = configure_rigid_bodies(configuration)
+
+    baseline_detector = _make_detector(ar_dicts,
+                                       {'detector preset' : 'accurate'})
+    baseline = [_marker_counts(baseline_detector.detect(frame))
+                for frame in frames]
+    if not any(baseline):
+        raise ValueError('No markers found in any frame, can not tune')
+
+    return [evaluate(frames, ar_dicts, settings, baseline) + (settings,)
+            for settings in search_space]
+
+
+def main(args = None):
+    """
+    Entry point for sksurgeryarucotracker-autotune. Prints the Pareto
+    optimal settings for a video, each as a tracker configuration.
+    """
+    parser = argparse.ArgumentParser(
+                    description = 'Search for the fastest ArUco detector '
+                                  'settings that still find the markers '
+                                  'in a recorded video')
+    parser.add_argument('video', help = 'the video to tune against')
+    parser.add_argument('-c', '--config',
+                        help = 'a JSON tracker configuration file')
+    parser.add_argument('-n', '--max-frames', type = int, default = None,
+                        help = 'the most frames of the video to use')
+    parsed_args = parser.parse_args(args)
+
+    configuration = {}
+    if parsed_args.config is not None:
+        with open(parsed_args.config, 'r', encoding = 'utf-8') as config_file:
+            configuration = json.load(config_file)
+
+    frames = read_frames(parsed_args.video, parsed_args.max_frames)
+    results = autotune(frames, configuration)
+    for recall, mean_time, p99_time, settings in pareto_front(results):
+        print(f'# recall {recall:.3f}, mean {1000 * mean_time:.1f} ms, '
+              f'p99 {1000 * p99_time:.1f} ms')
+        print(json.dumps(dict(configuration, **settings), indent = 4))
@@ -0,0 +1,258 @@
+#  -*- coding: utf-8 -*-
+
+"""Video capture classes for use with the ArUco tracker"""
+
+from threading import Condition, Thread
+from time import time, perf_counter
+import numpy
+import cv2
+
+
+class ThreadedCapture():
+    """
+    Wraps a cv2.VideoCapture so that frames are read continuously on
+    a background thread into a single latest frame slot. Older frames
+    are overwritten, so read always returns the newest frame from the
+    source rather than whatever is waiting in OpenCV's internal buffer.
+
+    The reading thread is started on the first call to read, so
+    capture properties can be set safely after open. The thread reads
+    into two buffers in turn, and read copies the newest frame out.
+    """
+
+    def __init__(self, timeout = 1.0):
+        """
+        :param timeout: the maximum time in seconds that read will wait
+            for a new frame
+        """
+        self._capture = cv2.VideoCapture()
+        self._timeout = timeout
+        self._condition = Condition()
+        self._buffers = [None, None]
+        self._latest = (None, None)
+        self._frames_captured = 0
+        self._frames_read = 0
+        self._read_grab_time = None
+        self._running = False
+        self._thread = None
+
+    def open(self, video_source):
+        """
+        Opens the video source.
+
+        :param video_source: anything that cv2.VideoCapture.open accepts
+        :return: True if the source was opened
+        """
+        return self._capture.open(video_source)
+
+    def set(self, cvprop, value):
+        """
+        Sets a property on the underlying cv2.VideoCapture
+
+        :return: True if the property was set
+        """
+        return self._capture.set(cvprop, value)
+
+    def get(self, cvprop):
+        """
+        Gets a property from the underlying cv2.VideoCapture
+        """
+        return self._capture.get(cvprop)
+
+    def read(self, image = None):
+        """
+        Returns the newest frame, waiting for one if no frame has arrived
+        since the last call to read.
+
+        :param image: an array to copy the frame into, if it has the
+            frame's shape and type, otherwise a new array is returned
+        :return: success (boolean) and the frame (None if failed)
+        """
+        with self._condition:
+            if self._thread is None:
+                self._running = True
+                self._thread = Thread(target = self._run, daemon = True)
+                self._thread.start()
+
+            self._condition.wait_for(
+                lambda: self._frames_captured > self._frames_read or
+                        not self._running, self._timeout)
+
+            if self._frames_captured > self._frames_read:
+                self._frames_read = self._frames_captured
+                frame, self._read_grab_time = self._latest
+                if image is None or image.shape != frame.shape or \
+                                image.dtype != frame.dtype:
+                    return True, frame.copy()
+                numpy.copyto(image, frame)
+                return True, image
+
+        return False, None
+
+    def get_grab_time(self):
+        """
+        :return: the time, as from time.time, that the last frame
+            returned by read was captured, or None before the first frame
+        """
+        return self._read_grab_time
+
+    def release(self):
+        """
+        Stops the reading thread and releases the video source.
+        """
+        with self._condition:
+            self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._capture.release()
+
+    def _run(self):
+        """
+        Reads frames until the source is exhausted or release is called.
+        """
+        index = 0
+        while self._running:
+            success, frame = self._capture.read(self._buffers[index])
+            grab_time = time()
+            with self._condition:
+                if not success:
+                    self._running = False
+                else:
+                    self._buffers[index] = frame
+                    self._latest = (frame, grab_time)
+                    self._frames_captured += 1
+                self._condition.notify_all()
+            index = 1 - index
+
+
+class DrainingCapture():
+    """
+    Wraps a cv2.VideoCapture so that read returns the newest frame
+    from a live source, rather than the oldest frame waiting in the
+    capture's internal queue. Queued frames are discarded with grab,
+    which does not decode them, until a grab has to wait for the
+    camera, and only that frame is retrieved and decoded.
+
+    A grab that returns in less than min_wait seconds is taken to have
+    come from the queue. This suits live sources only, as every grab
+    from a video file returns at once, so up to max_drain frames would
+    be skipped on every read. If the source ends while draining, the
+    frames grabbed so far are lost and read fails.
+    """
+
+    def __init__(self, max_drain = 10, min_wait = None):
+        """
+        :param max_drain: the most queued frames to discard per read
+        :param min_wait: the shortest time in seconds a grab that waited
+            for a new frame takes. Defaults to half the frame period
+            reported by the source, or 5 ms if it does not report one
+        """
+        self._capture = cv2.VideoCapture()
+        self._max_drain = max_drain
+        self._min_wait = min_wait
+        self._grab_time = None
+        self._frames_drained = 0
+
+    def open(self, video_source):
+        """
+        Opens the video source.
+
+        :param video_source: anything that cv2.VideoCapture.open accepts
+        :return: True if the source was opened
+        """
+        return self._capture.open(video_source)
+
+    def set(self, cvprop, value):
+        """
+        Sets a property on the underlying cv2.VideoCapture
+
+        :return: True if the property was set
+        """
+        return self._capture.set(cvprop, value)
+
+    def get(self, cvprop):
+        """
+        Gets a property from the underlying cv2.VideoCapture
+        """
+        return self._capture.get(cvprop)
+
+    def read(self, image = None):
+        """
+        Discards queued frames and returns the newest.
+
+        :param image: an array to decode the frame into, if it has the
+            frame's shape and type, otherwise a new array is returned
+        :return: success (boolean) and the frame (None if failed)
+        """
+        min_wait = self._min_wait
+        if min_wait is None:
+            frame_rate = self._capture.get(cv2.CAP_PROP_FPS)
+            min_wait = 0.5 / frame_rate if frame_rate > 0 else 0.005
+
+        grabbed = False
+        for _ in range(self._max_drain + 1):
+            start = perf_counter()
+            if grabbed:
+                self._frames_drained += 1
+            if not self._capture.grab():
+                return False, None
+            grabbed = True
+            self._grab_time = time()
+            if perf_counter() - start >= min_wait:
+                break
+
+        return self._capture.retrieve(image)
+
+    def get_grab_time(self):
+        """
+        :return: the time, as from time.time, that the last frame
+            returned by read was grabbed, or None before the first frame
+        """
+        return self._grab_time
+
+    def get_frames_drained(self):
+        """
+        :return: the number of queued frames discarded so far
+        """
+        return self._frames_drained
+
+    def release(self):
+        """
+        Releases the video source.
+        """
+        self._capture.release()
+
+
+class FramePool():
+    """
+    Reads frames from a capture into a ring of reusable buffers, so
+    reading does not allocate a new array for every frame. A frame is
+    overwritten size reads later, so anything that keeps a frame for
+    longer must copy it.
+    """
+
+    def __init__(self, size = 2):
+        """
+        :param size: the number of buffers
+        :raise ValueError: if size is less than 1
+        """
+        if size < 1:
+            raise ValueError(f'Frame pool needs at least 1 buffer, not {size}')
+        self._buffers = [None] * size
+        self._next = 0
+
+    def read(self, capture):
+        """
+        Reads a frame into the next buffer. Buffers are allocated by the
+        first read into them, and reallocated if the frame size changes.
+
+        :param capture: a cv2.VideoCapture, or anything else with a read
+            method that takes an image to read into
+        :return: success (boolean) and the frame (None if failed)
+        """
+        success, frame = capture.read(self._buffers[self._next])
+        if success and frame is not None:
+            self._buffers[self._next] = frame
+            self._next = (self._next + 1) % len(self._buffers)
+        return success, frame
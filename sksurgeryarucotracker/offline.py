@@ -0,0 +1,137 @@
+#  -*- coding: utf-8 -*-
+
+"""Tracks recorded video, split across worker processes"""
+
+from os import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import cv2
+
+from sksurgeryarucotracker.arucotracker import ArUcoTracker
+
+
+def frame_ranges(frame_count, shards):
+    """
+    Splits a video into contiguous ranges of frames.
+
+    :param frame_count: the number of frames in the video
+    :param shards: the number of ranges to split it into
+    :return: a list of (start, stop) frame indices, without empty ranges
+    """
+    bounds = numpy.linspace(0, frame_count, shards + 1).round().astype(int)
+    return [(int(start), int(stop)) for start, stop in
+            zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def _track_range(path, configuration, start, stop):
+    """
+    Tracks a range of frames of a video with a tracker of its own.
+
+    :return: frame indices, port handles, tracking matrices and
+        qualities, one of each per tool per frame
+    """
+    configuration = dict(configuration, **{'video source' : path})
+    tracker = ArUcoTracker(configuration)
+    tracker.start_tracking()
+    frame_indices = []
+    port_handles = []
+    tracking = []
+    quality = []
+    for frame_index, result in tracker.iter_frames(start = start,
+                                                   stop = stop):
+        frame_indices.extend([frame_index] * len(result[0]))
+        port_handles.extend(result[0])
+        tracking.extend(result[3])
+        quality.extend(result[4])
+    tracker.close()
+    return frame_indices, port_handles, tracking, quality
+
+
+def process_video(path, configuration, workers = None):
+    """
+    Tracks every frame of a recorded video. The video is split into
+    one range of frames per worker, and each worker process tracks its
+    range with a tracker of its own, seeking to the start of the range.
+
+    Trackers start each range afresh, so configurations that carry
+    state between frames, such as smoothing, roi detection, optical
+    flow or the motion gate, may give slightly different tracking just
+    after the start of each range than a single tracker would.
+
+    :param path: the path to the video
+    :param configuration: an ArUcoTracker configuration. The video
+        source is set to path, and threaded capture, drain stale
+        frames and use quaternions are turned off, so tracking is
+        always given as 4x4 matrices
+    :param workers: the number of worker processes, defaults to the
+        number of processors. With 1, the video is tracked in this
+        process
+    :return: a dictionary of columns, one row per tool per frame, in
+        frame order. 'frame index' gives the frame, 'tool handle' the
+        tool, as an index into 'tool names', 'tracking' the 4x4
+        tracking matrix and 'quality' the tracking quality
+    :raise OSError: if the video can not be opened
+    :raise ValueError: if workers is less than 1
+    """
+    if workers is None:
+        workers = cpu_count() or 1
+    if workers < 1:
+        raise ValueError(f'Need at least 1 worker, not {workers}')
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise OSError(f'Failed to open video {path}')
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+
+    configuration = dict(configuration, **{'threaded capture' : False,
+                                           'drain stale frames' : False,
+                                           'use quaternions' : False,
+                                           'debug' : False})
+    ranges = [(0, None)]
+    if frame_count > 0:
+        ranges = frame_ranges(frame_count, workers)
+        #the frame count is only an estimate, so the last range runs
+        #to the end of the video
+        ranges[-1] = (ranges[-1][0], None)
+
+    if workers == 1 or len(ranges) == 1:
+        shards = [_track_range(path, configuration, start, stop)
+                  for start, stop in ranges]
+    else:
+        with ProcessPoolExecutor(max_workers = len(ranges)) as executor:
+            shards = list(executor.map(_track_range,
+                            [path] * len(ranges),
+                            [configuration] * len(ranges),
+                            [start for start, _ in ranges],
+                            [stop for _, stop in ranges]))
+
+    return _merge(shards)
+
+
+def _merge(shards):
+    """
+    Joins the results of each range of frames, in order, into columns
+    """
+    tool_names = []
+    tool_handles = {}
+    frame_indices = []
+    handles = []
+    tracking = []
+    quality = []
+    for shard_indices, port_handles, shard_tracking, shard_quality in shards:
+        for port_handle in port_handles:
+            if port_handle not in tool_handles:
+                tool_handles[port_handle] = len(tool_names)
+                tool_names.append(port_handle)
+            handles.append(tool_handles[port_handle])
+        frame_indices.extend(shard_indices)
+        tracking.extend(shard_tracking)
+        quality.extend(shard_quality)
+
+    tracking = numpy.array(tracking, dtype = numpy.float64)
+    return {'tool names' : tool_names,
+            'frame index' : numpy.array(frame_indices, dtype = numpy.int64),
+            'tool handle' : numpy.array(handles, dtype = numpy.int64),
+            'tracking' : tracking.reshape((-1, 4, 4)),
+            'quality' : numpy.array(quality, dtype = numpy.float64)}
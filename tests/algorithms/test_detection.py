@@ -0,0 +1,478 @@
+#  -*- coding: utf-8 -*-
+"""Tests for the marker detection classes"""
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import numpy as np
+import cv2
+from cv2 import aruco
+import sksurgeryarucotracker.algorithms.detection as det
+
+# pylint: disable=no-member
+
+def _get_dictionaries(names):
+    """
+    Returns a list of aruco dictionaries
+    """
+    return [aruco.getPredefinedDictionary(getattr(aruco, name))
+            for name in names]
+
+
+def test_single_pass_matches_serial():
+    """
+    Single pass detection should find the same markers, in the same
+    order, as detecting each dictionary separately
+    """
+    ar_dicts = _get_dictionaries(['DICT_4X4_50', 'DICT_ARUCO_ORIGINAL',
+                                  'DICT_7X7_250'])
+    serial = det.MarkerDetector(ar_dicts, single_pass = False)
+    single_pass = det.MarkerDetector(ar_dicts, single_pass = True)
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    for _frame in range(3):
+        _, image = capture.read()
+        serial_detections = serial.detect(image)
+        single_pass_detections = single_pass.detect(image)
+        assert len(serial_detections) == 3
+        assert len(single_pass_detections) == 3
+        for (corners_a, ids_a), (corners_b, ids_b) in zip(
+                        serial_detections, single_pass_detections):
+            if ids_a is None:
+                assert ids_b is None
+                continue
+            assert np.array_equal(ids_a, ids_b)
+            for corner_a, corner_b in zip(corners_a, corners_b):
+                assert np.allclose(corner_a, corner_b)
+
+    assert single_pass_detections[0][1][0] == 0
+    assert len(single_pass_detections[1][1]) == 17
+    assert single_pass_detections[2][1] is None
+    capture.release()
+
+
+def test_detection_with_executor():
+    """
+    Detecting each dictionary on an executor should give the same
+    results, in the same order, as detecting them in turn
+    """
+    ar_dicts = _get_dictionaries(['DICT_4X4_50', 'DICT_ARUCO_ORIGINAL',
+                                  'DICT_7X7_250'])
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+    with ThreadPoolExecutor(3) as executor:
+        for single_pass in [False, True]:
+            detections = det.MarkerDetector(ar_dicts, single_pass).detect(
+                            image)
+            threaded_detections = det.MarkerDetector(ar_dicts, single_pass,
+                            executor = executor).detect(image)
+            for (corners_a, ids_a), (corners_b, ids_b) in zip(
+                            detections, threaded_detections):
+                assert np.array_equal(ids_a, ids_b)
+                assert np.array_equal(corners_a, corners_b)
+
+
+class _MultiDictStub():
+    """
+    Stands in for an aruco.ArucoDetector from an OpenCV version with
+    detectMarkersMultiDict, returning a fixed result
+    """
+    result = ((), None, (), [])
+
+    def __init__(self, dictionary, parameters):
+        self.dictionary = dictionary
+        self.parameters = parameters
+
+    def detectMarkers(self, _frame): # pylint: disable=invalid-name
+        """
+        Not used when a multi dictionary detector is available
+        """
+        raise AssertionError('detectMarkers should not be called')
+
+    def detectMarkersMultiDict(self, _frame): # pylint: disable=invalid-name
+        """
+        :return: the fixed result
+        """
+        return _MultiDictStub.result
+
+
+def test_multi_dict_detection(monkeypatch):
+    """
+    Markers found by a multi dictionary detector should be split by
+    dictionary, in the order found, with ((), None) for dictionaries
+    with no markers
+    """
+    monkeypatch.setattr(det.aruco, 'ArucoDetector', _MultiDictStub)
+    ar_dicts = _get_dictionaries(['DICT_4X4_50', 'DICT_ARUCO_ORIGINAL',
+                                  'DICT_7X7_250'])
+    detector = det.MarkerDetector(ar_dicts)
+    image = np.zeros((48, 64), dtype = np.uint8)
+
+    assert detector.detect(image) == [((), None)] * 3
+
+    corners = tuple(np.full((1, 4, 2), value, dtype = np.float32)
+                    for value in [1.0, 2.0, 3.0])
+    monkeypatch.setattr(_MultiDictStub, 'result',
+                        (corners, np.array([[5], [7], [9]]), (), [0, 2, 0]))
+    detections = detector.detect(image)
+    assert len(detections) == 3
+    assert np.array_equal(detections[0][1], [[5], [9]])
+    assert np.array_equal(detections[0][0][0], corners[0])
+    assert np.array_equal(detections[0][0][1], corners[2])
+    assert detections[1] == ((), None)
+    assert np.array_equal(detections[2][1], [[7]])
+    assert np.array_equal(detections[2][0][0], corners[1])
+
+
+def test_identify_no_candidates():
+    """
+    With no candidates nothing is identified
+    """
+    ar_dicts = _get_dictionaries(['DICT_4X4_50'])
+    image = np.zeros((480, 640), dtype = np.uint8)
+    corners, ids = det.identify_candidates(image, [], ar_dicts[0],
+                                           aruco.DetectorParameters())
+    assert not corners
+    assert ids is None
+
+
+def test_undistort_detections():
+    """
+    Corners from every dictionary are undistorted together, with
+    dictionaries that found nothing left alone
+    """
+    camera_matrix = np.array([[560.0, 0.0, 320.0],
+                              [0.0, 560.0, 240.0],
+                              [0.0, 0.0, 1.0]])
+    corners = (np.array([[[100., 100.], [200., 100.],
+                          [200., 200.], [100., 200.]]], dtype = np.float32),
+               np.array([[[320., 240.], [340., 240.],
+                          [340., 260.], [320., 260.]]], dtype = np.float32))
+    detections = [(corners, np.array([[3], [7]])), ((), None),
+                  (corners[0:1], np.array([[9]]))]
+
+    undistorted = det.undistort_detections(detections, camera_matrix,
+                                           np.zeros(5))
+    assert len(undistorted) == 3
+    assert undistorted[1] == ((), None)
+    assert np.allclose(undistorted[0][0][1], corners[1], atol = 1e-3)
+    assert np.allclose(undistorted[2][0][0], corners[0], atol = 1e-3)
+    assert np.array_equal(undistorted[2][1], [[9]])
+
+    undistorted = det.undistort_detections(detections, camera_matrix,
+                                           np.array([0.1, 0., 0., 0., 0.]))
+    #the principal point doesn't move, corners away from it do
+    assert np.allclose(undistorted[0][0][1][0, 0], corners[1][0, 0],
+                       atol = 1e-3)
+    assert not np.allclose(undistorted[0][0][0], corners[0], atol = 1.0)
+
+    assert det.undistort_detections([((), None)], camera_matrix,
+                                    np.zeros(5)) == [((), None)]
+
+
+def test_regions_from_points():
+    """
+    Regions are padded, clipped to the frame, and merged when
+    they overlap
+    """
+    point_sets = [np.array([[100., 100.], [120., 120.]]),
+                  np.array([[130., 130.], [140., 150.]]),
+                  np.array([[600., 400.], [630., 470.]]),
+                  np.array([[np.nan, np.nan]])]
+    regions = det.regions_from_points(point_sets, (480, 640, 3),
+                                      padding = 0.5, min_padding = 16)
+    assert regions == [[84, 84, 156, 166], [565, 365, 640, 480]]
+    assert not det.regions_from_points([], (480, 640))
+
+
+def test_roi_detector():
+    """
+    Detecting in regions around the previous markers should find
+    the same markers as searching the whole frame
+    """
+    ar_dicts = _get_dictionaries(['DICT_ARUCO_ORIGINAL'])
+    detector = det.MarkerDetector(ar_dicts)
+    roi_detector = det.RegionOfInterestDetector(detector,
+                                                full_scan_interval = 3)
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    full = roi_detector.detect(image, [])
+    assert roi_detector.last_scan_was_full
+
+    predicted = [np.reshape(corners, (-1, 2)) for corners in full[0][0]]
+    for frame in range(4):
+        detections = roi_detector.detect(image, predicted)
+        assert roi_detector.last_scan_was_full == (frame == 2)
+        assert np.array_equal(np.sort(np.ravel(detections[0][1])),
+                              np.sort(np.ravel(full[0][1])))
+
+    #markers too small for the whole frame are too small for a region
+    small_limit = det.MarkerDetector(ar_dicts, parameters =
+                    det.detector_parameters(
+                        parameters = {'minMarkerPerimeterRate' : 0.2}))
+    assert small_limit.detect(image)[0][1] is None
+    roi_detector = det.RegionOfInterestDetector(small_limit)
+    roi_detector.detect(image, predicted)
+    assert roi_detector.detect(image, predicted)[0][1] is None
+    assert not roi_detector.last_scan_was_full
+    capture.release()
+
+
+def test_corner_flow_tracker():
+    """
+    Markers followed with optical flow should stay on the markers,
+    with a full detection due every detection_interval frames
+    """
+    ar_dicts = _get_dictionaries(['DICT_ARUCO_ORIGINAL'])
+    detector = det.MarkerDetector(ar_dicts)
+    flow_tracker = det.CornerFlowTracker(detection_interval = 3)
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    assert flow_tracker.track(image) is None
+    flow_tracker.set_detections(image, detector.detect(image))
+
+    for frame in range(3):
+        _, image = capture.read()
+        tracked = flow_tracker.track(image)
+        if frame == 2:
+            assert tracked is None
+            continue
+        detected = detector.detect(image)
+        for marker_id, corners in zip(np.ravel(tracked[0][1]), tracked[0][0]):
+            matches = np.flatnonzero(np.ravel(detected[0][1]) == marker_id)
+            if len(matches) == 1:
+                assert np.allclose(corners, detected[0][0][matches[0]],
+                                   atol = 2.0)
+
+    #a blank frame loses all the markers
+    assert det.CornerFlowTracker().track(np.zeros_like(image)) is None
+    flow_tracker.set_detections(image, detector.detect(image))
+    assert flow_tracker.track(np.zeros_like(image)) is None
+    capture.release()
+
+
+def test_flow_tracker_keeps_copy():
+    """
+    The flow tracker should keep its own copy of a greyscale frame, so
+    the caller can reuse the frame's buffer
+    """
+    ar_dicts = _get_dictionaries(['DICT_ARUCO_ORIGINAL'])
+    detector = det.MarkerDetector(ar_dicts)
+    flow_tracker = det.CornerFlowTracker()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    flow_tracker.set_detections(grey, detector.detect(grey))
+    buffer = grey.copy()
+    grey[:] = 0
+    assert flow_tracker.track(buffer) is not None
+
+
+def test_pyramid_detector():
+    """
+    Markers detected at reduced scale should have the corners found by
+    sub-pixel refinement at full resolution, in the native resolution
+    video where each marker cell is only about 4 pixels across
+    """
+    ar_dicts = _get_dictionaries(['DICT_ARUCO_ORIGINAL'])
+    detector = det.MarkerDetector(ar_dicts)
+    parameters = aruco.DetectorParameters()
+    parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
+    full_detector = det.MarkerDetector(ar_dicts, parameters = parameters)
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    images = []
+    success, image = capture.read()
+    while success:
+        images.append(image)
+        success, image = capture.read()
+    capture.release()
+
+    for scale in [0.5, 0.75]:
+        pyramid = det.PyramidDetector(detector, scale)
+        assert pyramid.dictionary_count() == 1
+        errors = []
+        for image in images:
+            full_corners, full_ids = full_detector.detect(image)[0]
+            full_ids = np.ravel(full_ids)
+            corners, marker_ids = pyramid.detect(image)[0]
+            assert len(marker_ids) >= len(full_ids) - 2
+            for marker_id, marker_corners in zip(np.ravel(marker_ids),
+                                                 corners):
+                row = np.flatnonzero(full_ids == marker_id)[0]
+                errors.extend(np.linalg.norm(
+                            marker_corners - full_corners[row],
+                            axis = 2).ravel())
+        assert len(errors) > 500
+        assert np.max(errors) < 0.01
+
+    image = cv2.resize(images[0], None, fx = 4, fy = 4,
+                       interpolation = cv2.INTER_CUBIC)
+    auto = det.PyramidDetector(detector, 'auto', target_marker_size = 40)
+    assert auto.get_scale() == 1.0
+    auto.detect(image)
+    assert auto.get_scale() == 0.5
+    auto.detect(np.zeros_like(image))
+    assert auto.get_scale() == 1.0
+
+    for scale in [0.0, 1.5]:
+        with pytest.raises(ValueError):
+            det.PyramidDetector(detector, scale)
+
+
+def test_refine_corners():
+    """
+    Refining corners should give the same result as aruco's sub-pixel
+    refinement, with the window kept inside one marker cell
+    """
+    ar_dicts = _get_dictionaries(['DICT_ARUCO_ORIGINAL'])
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    parameters = aruco.DetectorParameters()
+    corners, _ = det.MarkerDetector(ar_dicts, parameters = parameters
+                                    ).detect(grey)[0]
+    parameters.cornerRefinementMethod = aruco.CORNER_REFINE_SUBPIX
+    refined, _ = det.MarkerDetector(ar_dicts, parameters = parameters
+                                    ).detect(grey)[0]
+    for marker_corners, expected in zip(corners, refined):
+        assert np.allclose(det.refine_corners(grey, marker_corners,
+                                ar_dicts[0].markerSize, parameters),
+                           expected)
+
+    #a window wider than a cell would move corners onto the bit corners
+    parameters.relativeCornerRefinmentWinSize = 10.0
+    parameters.cornerRefinementWinSize = 50
+    wide = det.refine_corners(grey, corners[0], ar_dicts[0].markerSize,
+                              parameters)
+    assert np.max(np.linalg.norm(wide - refined[0], axis = 2)) < 2.0
+
+
+def test_tile_regions():
+    """
+    Tiles should cover the frame and overlap their neighbours
+    """
+    regions = det.tile_regions((480, 640, 3), (2, 2), 100)
+    assert regions == [[0, 0, 370, 290], [270, 0, 640, 290],
+                       [0, 190, 370, 480], [270, 190, 640, 480]]
+    assert det.tile_regions((480, 640), (1, 1), 100) == [[0, 0, 640, 480]]
+
+
+def test_remove_duplicate_markers():
+    """
+    Markers with the same id in the same place should be removed,
+    other markers kept
+    """
+    marker = np.array([[[10., 10.], [30., 10.], [30., 30.], [10., 30.]]],
+                      dtype = np.float32)
+    detections = [((marker, marker + 1.0, marker + 100.0, marker),
+                   np.array([[1], [1], [1], [2]], dtype = np.int32)),
+                  ((), None)]
+    unique = det.remove_duplicate_markers(detections)
+    assert np.array_equal(np.ravel(unique[0][1]), [1, 1, 2])
+    assert np.array_equal(unique[0][0][1], marker + 100.0)
+    assert unique[1] == ((), None)
+
+
+def test_tiled_detector():
+    """
+    Searching tiles in parallel should find the same markers as
+    searching the whole frame
+    """
+    ar_dicts = _get_dictionaries(['DICT_ARUCO_ORIGINAL', 'DICT_4X4_50'])
+    detector = det.MarkerDetector(ar_dicts)
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    with ThreadPoolExecutor(4) as executor:
+        tiled = det.TiledDetector(detector, executor, (2, 2), 150)
+        assert tiled.dictionary_count() == 2
+        for _frame in range(3):
+            _, image = capture.read()
+            full = detector.detect(image)
+            detections = tiled.detect(image)
+            for dict_index in range(2):
+                ids = np.ravel(detections[dict_index][1])
+                assert len(np.unique(ids)) == len(ids)
+                assert np.array_equal(
+                        np.sort(ids), np.sort(np.ravel(full[dict_index][1])))
+                for marker_id, corners in zip(ids,
+                                              detections[dict_index][0]):
+                    row = np.flatnonzero(np.ravel(full[dict_index][1]) ==
+                                         marker_id)[0]
+                    assert np.allclose(corners, full[dict_index][0][row])
+    capture.release()
+
+
+def test_motion_gate():
+    """
+    Frames should be static until they change by more than the
+    threshold, or too many frames in a row have been static
+    """
+    gate = det.MotionGate(threshold = 2.0, max_skipped_frames = 2)
+    image = np.full((480, 640, 3), 100, dtype = np.uint8)
+    assert not gate.is_static(image)
+    assert gate.is_static(image)
+    assert gate.is_static(image + 1)
+    assert not gate.is_static(image)
+    assert not gate.is_static(image + 3)
+    assert gate.is_static(image[:, :, 0] + 2)
+
+
+def test_detector_parameters():
+    """
+    Parameters should come from the preset, with individual
+    parameters set on top
+    """
+    defaults = aruco.DetectorParameters()
+    parameters = det.detector_parameters()
+    assert parameters.adaptiveThreshWinSizeStep == \
+                    defaults.adaptiveThreshWinSizeStep
+
+    parameters = det.detector_parameters('accurate')
+    assert parameters.cornerRefinementMethod == aruco.CORNER_REFINE_SUBPIX
+    assert parameters.adaptiveThreshWinSizeStep == 4
+
+    parameters = det.detector_parameters('fast',
+                    {'cornerRefinementMethod' : 'CORNER_REFINE_CONTOUR',
+                     'minMarkerPerimeterRate' : 0.05})
+    assert parameters.adaptiveThreshWinSizeMin == 13
+    assert parameters.cornerRefinementMethod == aruco.CORNER_REFINE_CONTOUR
+    assert np.isclose(parameters.minMarkerPerimeterRate, 0.05)
+
+    copied = det.copy_parameters(parameters)
+    assert copied.adaptiveThreshWinSizeMin == 13
+    assert np.isclose(copied.minMarkerPerimeterRate, 0.05)
+
+    with pytest.raises(ValueError):
+        det.detector_parameters('slow')
+    with pytest.raises(ValueError):
+        det.detector_parameters(None, {'notAParameter' : 1})
+
+
+def test_presets_detect_markers():
+    """
+    Every preset should find the markers, and single pass detection
+    should match detecting each dictionary when corners are refined
+    """
+    ar_dicts = _get_dictionaries(['DICT_ARUCO_ORIGINAL', 'DICT_4X4_50'])
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+
+    expected_ids = np.sort(np.ravel(
+                    det.MarkerDetector(ar_dicts).detect(image)[0][1]))
+    for preset in det.DETECTOR_PRESETS:
+        parameters = det.detector_parameters(preset)
+        single_pass = det.MarkerDetector(ar_dicts, True, parameters)
+        serial = det.MarkerDetector(ar_dicts, False, parameters)
+        detections = single_pass.detect(image)
+        assert np.array_equal(np.sort(np.ravel(detections[0][1])),
+                              expected_ids)
+        for (corners_a, ids_a), (corners_b, ids_b) in zip(
+                        detections, serial.detect(image)):
+            assert np.array_equal(ids_a, ids_b)
+            assert np.allclose(corners_a, corners_b)
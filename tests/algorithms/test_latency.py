@@ -0,0 +1,59 @@
+#  -*- coding: utf-8 -*-
+"""Tests for the latency controller"""
+import pytest
+from sksurgeryarucotracker.algorithms.latency import LatencyController, \
+                LATENCY_LEVELS
+
+
+def test_level_changes():
+    """
+    The level should go up while over budget and down while well
+    under it, staying at each level for min_frames frames
+    """
+    controller = LatencyController(budget = 0.02, min_frames = 3)
+    assert controller.get_level() == 0
+    assert controller.get_mean_time() is None
+
+    levels = []
+    for _frame in range(9):
+        controller.update(0.05)
+        levels.append(controller.get_level())
+    assert levels == [0, 0, 1, 1, 1, 2, 2, 2, 3]
+    assert controller.get_settings() == LATENCY_LEVELS[3]
+
+    for _frame in range(30):
+        controller.update(0.05)
+    assert controller.get_level() == len(LATENCY_LEVELS) - 1
+
+    for _frame in range(30):
+        controller.update(0.015)
+    assert controller.get_level() == len(LATENCY_LEVELS) - 1
+
+    for _frame in range(60):
+        controller.update(0.001)
+    assert controller.get_level() == 0
+    assert controller.get_mean_time() < 0.002
+
+
+def test_skip_frames():
+    """
+    At levels that skip frames, the given number of frames should be
+    skipped after each processed frame
+    """
+    controller = LatencyController(budget = 0.02, min_frames = 1)
+    assert not controller.skip_frame()
+    while controller.get_level() < len(LATENCY_LEVELS) - 1:
+        controller.update(1.0)
+    frames_to_skip = LATENCY_LEVELS[-1][2]
+    assert frames_to_skip > 0
+    for _frame in range(frames_to_skip):
+        assert controller.skip_frame()
+    assert not controller.skip_frame()
+
+
+def test_invalid_budget():
+    """
+    The budget must be positive
+    """
+    with pytest.raises(ValueError):
+        LatencyController(budget = 0.0)
@@ -0,0 +1,192 @@
+#  -*- coding: utf-8 -*-
+"""Tests for 2D to 3D registration"""
+import numpy as np
+import cv2
+from cv2 import aruco
+import sksurgeryarucotracker.algorithms.rigid_bodies as rgbd
+import sksurgeryarucotracker.algorithms.registration_2d3d as reg
+
+# pylint: disable=no-member
+
+def _load_reference_corners():
+    """
+    Returns the reference board, and the markers detected in the first
+    frame of the multipattern video
+    """
+    board = rgbd.load_board_from_file('data/reference.txt')
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+    marker_corners, marker_ids, _ = aruco.detectMarkers(image,
+                    aruco.getPredefinedDictionary(aruco.DICT_ARUCO_ORIGINAL))
+    return board, marker_corners, marker_ids
+
+
+def test_pose_guess():
+    """
+    A good pose guess gives the same result as estimating from
+    scratch, a bad one is rejected
+    """
+    board, marker_corners, marker_ids = _load_reference_corners()
+    camera_matrix = np.loadtxt('data/calibration.txt', max_rows = 3)
+    distortion = np.loadtxt('data/calibration.txt', skiprows = 3,
+                            max_rows = 1)
+
+    rvec, tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, marker_ids, board, camera_matrix,
+                    distortion)
+
+    good_rvec, good_tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, marker_ids, board, camera_matrix,
+                    distortion, pose_guess = (rvec, tvec))
+    assert np.allclose(rvec, good_rvec, atol = 1e-4)
+    assert np.allclose(tvec, good_tvec, atol = 1e-2)
+
+    bad_rvec, bad_tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, marker_ids, board, camera_matrix,
+                    distortion, pose_guess = ([3.0, 0.0, 0.0],
+                                              [0.0, 0.0, -100.0]))
+    assert np.allclose(rvec, bad_rvec, atol = 1e-4)
+    assert np.allclose(tvec, bad_tvec, atol = 1e-2)
+
+
+def test_board_rows():
+    """
+    Board rows found when assigning markers give the same pose as
+    looking them up, and markers with no row are left out
+    """
+    board, marker_corners, marker_ids = _load_reference_corners()
+    camera_matrix = np.loadtxt('data/calibration.txt', max_rows = 3)
+    distortion = np.loadtxt('data/calibration.txt', skiprows = 3,
+                            max_rows = 1)
+
+    rvec, tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, marker_ids, board, camera_matrix,
+                    distortion)
+    rows = board.get_rows(marker_ids)
+    rows_rvec, rows_tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, marker_ids, board, camera_matrix,
+                    distortion, board_rows = rows)
+    assert np.allclose(rvec, rows_rvec)
+    assert np.allclose(tvec, rows_tvec)
+
+    rows = np.copy(rows)
+    rows[0] = -1
+    part_rvec, part_tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, marker_ids, board, camera_matrix,
+                    distortion, board_rows = rows)
+    subset_rvec, subset_tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners[1:], marker_ids[1:], board,
+                    camera_matrix, distortion)
+    assert np.allclose(part_rvec, subset_rvec)
+    assert np.allclose(part_tvec, subset_tvec)
+
+
+def test_select_pnp_solver():
+    """
+    Square single tags use IPPE_SQUARE, planar boards IPPE and
+    anything else SQPNP
+    """
+    tag = rgbd.load_board_from_file('data/tag_0.txt')
+    assert reg.select_pnp_solver(tag.corner_points) == \
+                    cv2.SOLVEPNP_IPPE_SQUARE
+    pointer = rgbd.load_board_from_file('data/pointer.txt')
+    assert reg.select_pnp_solver(pointer.corner_points) == cv2.SOLVEPNP_IPPE
+    non_planar = np.copy(pointer.corner_points)
+    non_planar[0, :, 2] = 10.0
+    assert reg.select_pnp_solver(non_planar) == cv2.SOLVEPNP_SQPNP
+
+
+def test_pnp_solvers_agree():
+    """
+    All the pose estimation methods should agree on a planar board,
+    EPNP is less accurate than the others
+    """
+    board, marker_corners, marker_ids = _load_reference_corners()
+    camera_matrix = np.loadtxt('data/calibration.txt', max_rows = 3)
+    distortion = np.loadtxt('data/calibration.txt', skiprows = 3,
+                            max_rows = 1)
+
+    rvec, tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, marker_ids, board, camera_matrix,
+                    distortion)
+    for solver, tolerance in [(cv2.SOLVEPNP_ITERATIVE, 1.0),
+                              (cv2.SOLVEPNP_IPPE, 1.0),
+                              (cv2.SOLVEPNP_SQPNP, 1.0),
+                              (cv2.SOLVEPNP_EPNP, 10.0)]:
+        solver_rvec, solver_tvec, _ = reg.estimate_poses_with_calibration(
+                        marker_corners, marker_ids, board, camera_matrix,
+                        distortion, solver = solver)
+        assert np.allclose(rvec, solver_rvec, atol = 0.02 * tolerance)
+        assert np.allclose(tvec, solver_tvec, atol = tolerance)
+
+
+def test_ippe_square():
+    """
+    IPPE_SQUARE should give the same pose as the iterative method on
+    the tag corners, including for tags defined with y downwards
+    """
+    tag = rgbd.single_tag_board(50.0, 0)
+    camera_matrix = np.array([[560.0, 0.0, 320.0],
+                              [0.0, 560.0, 240.0],
+                              [0.0, 0.0, 1.0]])
+    distortion = np.zeros(5)
+    rvec = np.array([0.3, -0.2, 0.1])
+    tvec = np.array([10.0, -5.0, 300.0])
+    projected, _ = cv2.projectPoints(tag.corner_points[0], rvec, tvec,
+                                     camera_matrix, distortion)
+    marker_corners = [projected.reshape(1, 4, 2).astype(np.float32)]
+
+    square_rvec, square_tvec, _ = reg.estimate_poses_with_calibration(
+                    marker_corners, [0], tag, camera_matrix, distortion,
+                    solver = cv2.SOLVEPNP_IPPE_SQUARE)
+    assert np.allclose(rvec, square_rvec, atol = 1e-3)
+    assert np.allclose(tvec, np.ravel(square_tvec), atol = 1e-2)
+
+
+def test_single_tag_poses():
+    """
+    Batched single tag pose estimation should recover the pose of
+    each tag
+    """
+    camera_matrix = np.array([[560.0, 0.0, 320.0],
+                              [0.0, 560.0, 240.0],
+                              [0.0, 0.0, 1.0]])
+    distortion = np.array([0.1, 0.0, 0.0, 0.0, 0.0])
+    tag_corners = np.array([[-25.0, 25.0, 0.], [25.0, 25.0, 0.],
+                            [25.0, -25.0, 0.], [-25.0, -25.0, 0.]])
+    rvecs = np.array([[0.3, -0.2, 0.1], [-0.1, 0.2, 3.0], [0.0, 0.4, 0.0]])
+    tvecs = np.array([[10.0, -5.0, 300.0], [-80.0, 40.0, 450.0],
+                      [60.0, 60.0, 250.0]])
+    marker_corners = []
+    for rvec, tvec in zip(rvecs, tvecs):
+        projected, _ = cv2.projectPoints(tag_corners, rvec, tvec,
+                                         camera_matrix, distortion)
+        marker_corners.append(projected.reshape(1, 4, 2).astype(np.float32))
+
+    found_rvecs, found_tvecs = reg.estimate_single_tag_poses(
+                    marker_corners, 50.0, camera_matrix, distortion)
+    assert found_rvecs.shape == (3, 3)
+    assert found_tvecs.shape == (3, 3)
+    assert np.allclose(found_rvecs, rvecs, atol = 1e-3)
+    assert np.allclose(found_tvecs, tvecs, atol = 0.1)
+
+
+def test_tracking_matrices():
+    """
+    Vectorised conversion to tracking matrices should match
+    cv2.Rodrigues, and propagate NaN
+    """
+    rvecs = [np.array([0.3, -0.2, 0.1]), np.zeros((1, 3)),
+             np.full((1, 3), np.nan), np.array([[0.0], [3.0], [0.5]])]
+    tvecs = [np.array([10.0, -5.0, 300.0]), np.zeros(3),
+             np.full((1, 3), np.nan), np.array([[1.0], [2.0], [3.0]])]
+    matrices = reg.tracking_matrices(rvecs, tvecs)
+    assert matrices.shape == (4, 4, 4)
+    for index in [0, 1, 3]:
+        assert np.allclose(matrices[index][0:3, 0:3],
+                           cv2.Rodrigues(np.ravel(rvecs[index]))[0])
+        assert np.allclose(matrices[index][0:3, 3], np.ravel(tvecs[index]))
+        assert np.array_equal(matrices[index][3], [0., 0., 0., 1.])
+    assert np.all(np.isnan(matrices[2][0:3, 0:4]))
+    assert reg.tracking_matrices([], []).shape == (0, 4, 4)
@@ -2,6 +2,7 @@
 """Tests for the rigid body classes"""
 import pytest
 import numpy as np
+import cv2
 from cv2 import aruco
 import sksurgeryarucotracker.algorithms.rigid_bodies as rgbd
 
@@ -76,3 +77,165 @@ def test_unequal_board():
     markerids=np.ones(10)
     with pytest.raises(ValueError):
         _ = rgbd.Board(markerpoints, "Fake Dictionary", markerids)
+
+
+def test_marker_index():
+    """
+    The marker index should route detected markers to the rigid
+    bodies they belong to, and report the markers it could not assign
+    """
+    #pylint: disable=protected-access
+    reference = rgbd.ArUcoRigidBody(rigid_body_name = 'reference')
+    reference.load_3d_points('data/reference.txt', 'DICT_ARUCO_ORIGINAL')
+    pointer = rgbd.ArUcoRigidBody(rigid_body_name = 'pointer')
+    pointer.load_3d_points('data/pointer.txt', 'DICT_ARUCO_ORIGINAL')
+    other_dict = rgbd.ArUcoRigidBody(rigid_body_name = 'other')
+    other_dict.load_3d_points('data/pointer.txt', 'DICT_4X4_50')
+
+    marker_index = rgbd.MarkerIndex(['DICT_4X4_50', 'DICT_ARUCO_ORIGINAL'],
+                                    [reference, pointer, other_dict])
+
+    reference_id = reference.get_marker_ids()[3]
+    pointer_id = pointer.get_marker_ids()[1]
+    marker_ids = np.array([[pointer_id], [999999], [reference_id]])
+    marker_corners = [np.full((1, 4, 2), row, dtype = np.float32)
+                      for row in range(3)]
+
+    unassigned = marker_index.assign(1, marker_corners, marker_ids)
+    assert np.array_equal(unassigned, [False, True, False])
+
+    assert reference._tags_2d.ids == [reference_id]
+    assert reference._tags_2d.board_rows == [3]
+    assert np.all(reference._tags_2d.points[0] == 2)
+    assert pointer._tags_2d.ids == [pointer_id]
+    assert pointer._tags_2d.board_rows == [1]
+    assert not other_dict._tags_2d.ids
+
+    unassigned = marker_index.assign(0, marker_corners, marker_ids)
+    assert np.array_equal(unassigned, [False, True, True])
+    assert other_dict._tags_2d.board_rows == [1]
+
+
+def test_single_tag_cache():
+    """
+    Single tag rigid bodies should be reused, and the least recently
+    seen evicted when the cache is full
+    """
+    #pylint: disable=protected-access
+    dictionary = aruco.getPredefinedDictionary(aruco.DICT_4X4_50)
+    cache = rgbd.SingleTagCache(tag_size = 50, max_size = 2)
+
+    tag_0 = cache.get('DICT_4X4_50', 0, dictionary)
+    assert tag_0.name == 'DICT_4X4_50:0'
+    assert np.array_equal(tag_0.get_marker_ids(), [0])
+    tag_0.set_2d_points([np.zeros((1, 4, 2))], np.array([0]))
+    assert len(tag_0._tags_2d.ids) == 1
+
+    assert cache.get('DICT_4X4_50', 0, dictionary) is tag_0
+    assert not tag_0._tags_2d.ids
+
+    tag_1 = cache.get('DICT_4X4_50', 1, dictionary)
+    assert len(cache) == 2
+    assert cache.get('DICT_4X4_50', 0, dictionary) is tag_0
+
+    _tag_2 = cache.get('DICT_4X4_50', 2, dictionary)
+    assert len(cache) == 2
+    assert cache.get('DICT_4X4_50', 0, dictionary) is tag_0
+    assert cache.get('DICT_4X4_50', 1, dictionary) is not tag_1
+
+
+def test_board_rows():
+    """
+    Boards store their corners as one contiguous array, and can look
+    up rows by marker id
+    """
+    board = rgbd.load_board_from_file('data/reference.txt')
+    assert board.corner_points.shape == (len(board.ids), 4, 3)
+    assert board.corner_points.dtype == np.float32
+    assert board.corner_points.flags['C_CONTIGUOUS']
+
+    rows = board.get_rows([board.ids[5], 999999, board.ids[0]])
+    assert np.array_equal(rows, [5, -1, 0])
+    assert np.array_equal(board.get_rows(board.ids),
+                          np.arange(len(board.ids)))
+
+
+def test_pnp_solver_configuration():
+    """
+    The pnp solver can be set by name or automatically, and should
+    be checked against the tag geometry
+    """
+    #pylint: disable=protected-access
+    configuration = {
+                        'rigid bodies' : [{
+                             'filename' : 'data/pointer.txt',
+                             'pnp solver' : 'auto'
+                        },
+                        {
+                             'filename' : 'data/tag_0.txt',
+                             'pnp solver' : 'auto'
+                        },
+                        {
+                             'filename' : 'data/reference.txt',
+                             'pnp solver' : 'SQPNP'
+                        },
+                        {
+                             'filename' : 'data/reference.txt'
+                        }]
+                    }
+    _, _, rigid_bodies = rgbd.configure_rigid_bodies(configuration)
+    assert rigid_bodies[0]._solver == cv2.SOLVEPNP_IPPE
+    assert rigid_bodies[1]._solver == cv2.SOLVEPNP_IPPE_SQUARE
+    assert rigid_bodies[2]._solver == cv2.SOLVEPNP_SQPNP
+    assert rigid_bodies[3]._solver is None
+
+    rigid_body = rgbd.ArUcoRigidBody(rigid_body_name = 'test')
+    rigid_body.load_3d_points('data/pointer.txt', 'DICT_ARUCO_ORIGINAL')
+    with pytest.raises(ValueError):
+        rigid_body.set_pnp_solver('IPPE_SQUARE')
+    with pytest.raises(ValueError):
+        rigid_body.set_pnp_solver('made up')
+
+
+def test_max_corner_motion():
+    """
+    The last pose should be reused until a corner moves too far
+    or different tags are seen
+    """
+    rigid_body = rgbd.ArUcoRigidBody(rigid_body_name = 'test')
+    rigid_body.add_single_tag(50, 0, aruco.DICT_4X4_50)
+    rigid_body.set_max_corner_motion(0.5)
+    projection = np.array([[560.0, 0.0, 320.0], [0.0, 560.0, 240.0],
+                           [0.0, 0.0, 1.0]])
+    distortion = np.zeros(5)
+    corners = np.array([[[300., 220.], [340., 220.], [340., 260.],
+                         [300., 260.]]], dtype = np.float32)
+
+    rigid_body.set_2d_points([corners], [[0]])
+    rvec, tvec, _ = rigid_body.get_pose(projection, distortion)
+    assert rigid_body.get_gate_counts() == (0, 1)
+
+    rigid_body.reset_2d_points()
+    rigid_body.set_2d_points([corners + 0.4], [[0]])
+    reused_rvec, reused_tvec, _ = rigid_body.get_pose(projection, distortion)
+    assert rigid_body.get_gate_counts() == (1, 1)
+    assert np.array_equal(rvec, reused_rvec)
+    assert np.array_equal(tvec, reused_tvec)
+
+    #motion is measured from the corners used for the last estimate
+    rigid_body.reset_2d_points()
+    rigid_body.set_2d_points([corners + 0.8], [[0]])
+    moved_rvec, moved_tvec, _ = rigid_body.get_pose(projection, distortion)
+    assert rigid_body.get_gate_counts() == (1, 2)
+    assert not np.array_equal(tvec, moved_tvec)
+    assert not np.array_equal(rvec, moved_rvec)
+
+    rigid_body.reset_2d_points()
+    rvec, _, quality = rigid_body.get_pose(projection, distortion)
+    assert np.isnan(rvec).all()
+    assert quality == 0.0
+    assert rigid_body.get_gate_counts() == (1, 2)
+
+    rigid_body.set_2d_points([corners + 0.8], [[0]])
+    rigid_body.get_pose(projection, distortion)
+    assert rigid_body.get_gate_counts() == (1, 3)
@@ -0,0 +1,136 @@
+# coding=utf-8
+
+"""Tests for the ArUco tracker's asyncio interface"""
+
+import asyncio
+import pytest
+import numpy as np
+from sksurgeryarucotracker.arucotracker import ArUcoTracker
+
+
+def test_get_frame_async():
+    """
+    get_frame_async should give the same tracking as get_frame
+    """
+    async def track(tracker):
+        return [await tracker.get_frame_async() for _ in range(5)]
+
+    results = []
+    for use_async in [False, True]:
+        tracker = ArUcoTracker({'video source' : 'data/output.avi'})
+        tracker.start_tracking()
+        if use_async:
+            results.append(asyncio.run(track(tracker)))
+        else:
+            results.append([tracker.get_frame() for _ in range(5)])
+        tracker.close()
+
+    for plain, asynchronous in zip(*results):
+        assert plain[0] == asynchronous[0]
+        assert np.allclose(plain[3], asynchronous[3])
+
+
+def _stream(config, delay = 0.0):
+    """
+    Streams all of a video, sleeping for delay after each result
+    """
+    async def consume(tracker):
+        results = []
+        async for result in tracker.stream():
+            results.append(result)
+            await asyncio.sleep(delay)
+        return results
+
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    results = asyncio.run(consume(tracker))
+    dropped = tracker.get_frames_dropped()
+    tracker.close()
+    return results, dropped
+
+
+def test_stream():
+    """
+    With a blocking drop policy every frame should be streamed, in
+    order, and a slow consumer with a dropping policy should miss some
+    """
+    results, dropped = _stream({'video source' : 'data/output.avi',
+                                'stream drop policy' : 'block'}, 0.01)
+    assert len(results) == 10
+    assert dropped == 0
+    assert [result[2][0] for result in results] == list(range(10))
+    assert all(result[0][0] == 'DICT_4X4_50:0' for result in results)
+
+    for policy in ['drop oldest', 'drop newest']:
+        results, dropped = _stream({'video source' : 'data/output.avi',
+                                    'stream drop policy' : policy,
+                                    'stream queue size' : 1}, 0.2)
+        assert len(results) + dropped == 10
+        assert dropped > 0
+        frame_numbers = [result[2][0] for result in results]
+        assert frame_numbers == sorted(frame_numbers)
+
+
+def test_stream_early_exit():
+    """
+    Breaking out of a stream should stop it, leaving the tracker usable
+    """
+    async def first(tracker):
+        async for result in tracker.stream():
+            return result
+        return None
+
+    tracker = ArUcoTracker({'video source' : 'data/output.avi'})
+    tracker.start_tracking()
+    assert asyncio.run(first(tracker))[0][0] == 'DICT_4X4_50:0'
+    tracker.get_frame()
+    tracker.close()
+
+
+def test_stream_errors():
+    """
+    Streaming needs a video source and a known drop policy
+    """
+    with pytest.raises(ValueError):
+        ArUcoTracker({'video source' : 'none',
+                      'stream drop policy' : 'drop all'})
+
+    async def consume(tracker):
+        async for _ in tracker.stream():
+            pass
+
+    tracker = ArUcoTracker({'video source' : 'none'})
+    tracker.start_tracking()
+    with pytest.raises(ValueError):
+        asyncio.run(consume(tracker))
+    tracker.close()
+
+
+def test_stream_tracking_error(monkeypatch):
+    """
+    An error while tracking should reach the consumer, rather than
+    ending the stream as if the video had run out
+    """
+    tracker = ArUcoTracker({'video source' : 'data/output.avi',
+                            'stream drop policy' : 'block'})
+    tracker.start_tracking()
+    get_frame = tracker.get_frame
+    calls = []
+    results = []
+
+    def fail_on_fourth_frame(frame = None):
+        calls.append(frame)
+        if len(calls) == 4:
+            raise ValueError('tracking failed')
+        return get_frame(frame)
+
+    monkeypatch.setattr(tracker, 'get_frame', fail_on_fourth_frame)
+
+    async def consume(tracker):
+        async for result in tracker.stream():
+            results.append(result)
+
+    with pytest.raises(ValueError, match = 'tracking failed'):
+        asyncio.run(consume(tracker))
+    assert len(results) == 3
+    tracker.close()
@@ -0,0 +1,52 @@
+#  -*- coding: utf-8 -*-
+"""Tests for the ArUco tracker's detector configuration"""
+import pytest
+import numpy as np
+import cv2
+from sksurgeryarucotracker.arucotracker import ArUcoTracker
+
+
+def test_detector_presets():
+    """
+    Each detector preset should track the reference, and bad
+    detector configurations should be rejected
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    (_port_handles, _timestamps, _framenumbers,
+     tracking, _quality) = tracker.get_frame(image)
+
+    for preset in ['fast', 'balanced', 'accurate']:
+        preset_tracker = ArUcoTracker(dict(config, **{
+                        'detector preset' : preset,
+                        'detector parameters' : {
+                                'minMarkerPerimeterRate' : 0.02}}))
+        preset_tracker.start_tracking()
+        (_port_handles, _timestamps, _framenumbers,
+         preset_tracking, quality) = preset_tracker.get_frame(image)
+        assert quality[0] > 0.9
+        assert np.allclose(preset_tracking[0][0:3, 3], tracking[0][0:3, 3],
+                           atol = 3.0)
+        preset_tracker.stop_tracking()
+        preset_tracker.close()
+
+    with pytest.raises(ValueError):
+        ArUcoTracker(dict(config, **{'detector preset' : 'slow'}))
+    with pytest.raises(ValueError):
+        ArUcoTracker(dict(config, **{'detector parameters' :
+                                     {'windowSize' : 3}}))
+    tracker.stop_tracking()
+    tracker.close()
@@ -0,0 +1,51 @@
+#  -*- coding: utf-8 -*-
+"""Tests for the latency budget of the ArUco tracker"""
+import pytest
+import numpy as np
+import cv2
+from sksurgeryarucotracker.arucotracker import ArUcoTracker
+
+
+def test_latency_budget():
+    """
+    A tracker that can not meet its latency budget should degrade
+    step by step, ending up skipping frames
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'latency budget' : 1e-9,
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    assert tracker.get_latency_level() == 0
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+    levels = []
+    reused = []
+    for _frame in range(80):
+        (port_handles, _timestamps, _framenumbers,
+         tracking, quality) = tracker.get_frame(image)
+        levels.append(tracker.get_latency_level())
+        reused.append(tracker.frame_reused())
+        assert port_handles[0] == 'reference'
+        if levels[-1] < 2:
+            assert quality[0] > 0.9
+            assert not np.isnan(tracking[0]).any()
+
+    assert levels == sorted(levels)
+    assert levels[-1] == 4
+    assert not any(reused[0:30])
+    assert reused[-3:].count(True) == 2
+    tracker.stop_tracking()
+    tracker.close()
+
+    with pytest.raises(ValueError):
+        ArUcoTracker(dict(config, **{'latency budget' : -1}))
@@ -2,8 +2,10 @@
 
 """scikit-surgeryarucotracker tests"""
 
+import pytest
 import numpy as np
-from sksurgeryarucotracker.arucotracker import ArUcoTracker
+import cv2
+from sksurgeryarucotracker.arucotracker import ArUcoTracker, TrackingArrays
 from sksurgeryarucotracker.algorithms.compare_matrices \
         import matrices_equivalent
 
@@ -494,3 +496,461 @@ def test_with_no_tags_and_calib():
 
     tracker.stop_tracking()
     tracker.close()
+
+
+def test_warm_start():
+    """
+    Warm started pose estimation should give the same result as
+    estimating each frame from scratch
+    """
+    rigid_body = {'name' : 'reference',
+                  'filename' : 'data/reference.txt',
+                  'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'}
+    config = {'video source' : 'data/multipattern.avi',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : [rigid_body]}
+    warm_config = {'video source' : 'data/multipattern.avi',
+                   'calibration' : 'data/calibration.txt',
+                   'rigid bodies' : [dict(rigid_body, **{'warm start' : True})]}
+
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    warm_tracker = ArUcoTracker(warm_config)
+    warm_tracker.start_tracking()
+
+    for _frame in range(5):
+        (port_handles, _timestamps, _framenumbers,
+         tracking, _quality) = tracker.get_frame()
+        (warm_port_handles, _timestamps, _framenumbers,
+         warm_tracking, _quality) = warm_tracker.get_frame()
+
+        assert port_handles == warm_port_handles
+        reference_index = port_handles.index('reference')
+        assert matrices_equivalent(tracking[reference_index],
+                                   warm_tracking[reference_index],
+                                   tolerance = 0.5)
+
+    tracker.stop_tracking()
+    tracker.close()
+    warm_tracker.stop_tracking()
+    warm_tracker.close()
+
+
+def test_undistort_corners():
+    """
+    Undistorting the corners before pose estimation should give
+    nearly the same result as estimating with distortion
+    """
+    rigid_bodies = [{'name' : 'reference',
+                     'filename' : 'data/reference.txt',
+                     'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'}]
+    config = {'video source' : 'data/multipattern.avi',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : rigid_bodies}
+    undistort_config = dict(config, **{'undistort corners' : True})
+
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    undistort_tracker = ArUcoTracker(undistort_config)
+    undistort_tracker.start_tracking()
+
+    (port_handles, _timestamps, _framenumbers,
+     tracking, _quality) = tracker.get_frame()
+    (undistort_port_handles, _timestamps, _framenumbers,
+     undistort_tracking, _quality) = undistort_tracker.get_frame()
+
+    assert port_handles == undistort_port_handles
+    for index, _ in enumerate(port_handles):
+        assert matrices_equivalent(tracking[index],
+                                   undistort_tracking[index],
+                                   tolerance = 2.0)
+
+    tracker.stop_tracking()
+    tracker.close()
+    undistort_tracker.stop_tracking()
+    undistort_tracker.close()
+
+
+def test_get_frame_arrays():
+    """
+    get_frame_arrays should return the same tracking as get_frame,
+    as arrays, and can write into preallocated buffers
+    """
+    config = {'video source' : 'data/multipattern.avi',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      },
+                      {
+                        'name' : 'pointer',
+                        'filename' : 'data/pointer.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      },
+                      {
+                        'name' : 'not_seen',
+                        'filename' : 'data/pointer.txt',
+                        'aruco dictionary' : 'DICT_7X7_250'
+                      }
+                      ]
+              }
+
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    array_tracker = ArUcoTracker(config)
+    array_tracker.start_tracking()
+    assert array_tracker.get_tool_names() == ['reference', 'pointer',
+                                              'not_seen']
+
+    buffers = TrackingArrays(10)
+    for frame in range(3):
+        (port_handles, timestamps, _framenumbers,
+         tracking, quality) = tracker.get_frame()
+        result = array_tracker.get_frame_arrays(out = buffers)
+        assert result is buffers
+        assert result.count == len(port_handles) == 5
+        assert result.frame_number == frame
+        assert np.isclose(result.timestamp, timestamps[0], atol = 1.0)
+
+        tool_names = array_tracker.get_tool_names()
+        for index in range(result.count):
+            name = tool_names[result.tool_handles[index]]
+            assert name == port_handles[index]
+            assert np.isclose(result.quality[index], quality[index])
+            if name == 'not_seen':
+                assert np.all(np.isnan(result.tracking[index][0:3, 0:4]))
+                continue
+            assert np.allclose(result.tracking[index], tracking[index],
+                               atol = 1e-4)
+
+    with pytest.raises(ValueError):
+        array_tracker.get_frame_arrays(out = TrackingArrays(2))
+
+    result = array_tracker.get_frame_arrays()
+    assert result.capacity == result.count
+    assert result.tracking.shape == (result.count, 4, 4)
+
+    tracker.stop_tracking()
+    tracker.close()
+    array_tracker.stop_tracking()
+    array_tracker.close()
+
+
+def test_roi_detection():
+    """
+    Tracking with roi detection should give the same results as
+    searching the whole of every frame, and go back to a full search
+    when a tool is lost
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    roi_tracker = ArUcoTracker(dict(config, **{'roi detection' : True}))
+    roi_tracker.start_tracking()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    for _frame in range(4):
+        _, image = capture.read()
+        (port_handles, _timestamps, _framenumbers,
+         tracking, quality) = tracker.get_frame(image)
+        (roi_port_handles, _timestamps, _framenumbers,
+         roi_tracking, roi_quality) = roi_tracker.get_frame(image)
+        assert port_handles == roi_port_handles
+        assert quality == roi_quality
+        for index, _ in enumerate(port_handles):
+            assert matrices_equivalent(tracking[index], roi_tracking[index],
+                                       tolerance = 0.1)
+
+    #move the image, the tags are no longer where they were
+    image = np.roll(image, 200, axis = 1)
+    (port_handles, _timestamps, _framenumbers,
+     _tracking, quality) = tracker.get_frame(image)
+    (roi_port_handles, _timestamps, _framenumbers,
+     _tracking, roi_quality) = roi_tracker.get_frame(image)
+    assert sorted(port_handles) == sorted(roi_port_handles)
+    assert quality[0] == roi_quality[0]
+
+    capture.release()
+    tracker.stop_tracking()
+    tracker.close()
+    roi_tracker.stop_tracking()
+    roi_tracker.close()
+
+
+def test_optical_flow():
+    """
+    Following markers with optical flow between detections should
+    track the rigid bodies about as well as detecting every frame
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      },
+                      {
+                        'name' : 'pointer',
+                        'filename' : 'data/pointer.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    flow_tracker = ArUcoTracker(dict(config, **{'optical flow' : True,
+                                                'detection interval' : 5}))
+    flow_tracker.start_tracking()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    for frame in range(10):
+        _, image = capture.read()
+        (port_handles, _timestamps, _framenumbers,
+         tracking, quality) = tracker.get_frame(image)
+        (flow_port_handles, _timestamps, _framenumbers,
+         flow_tracking, flow_quality) = flow_tracker.get_frame(image)
+        assert port_handles == flow_port_handles
+        for index in range(2):
+            assert flow_quality[index] >= quality[index]
+            tolerance = 1.5
+            if frame % 5 == 0:
+                tolerance = 1e-6
+            assert np.allclose(flow_tracking[index][0:3, 3],
+                               tracking[index][0:3, 3], atol = tolerance)
+
+    capture.release()
+    tracker.stop_tracking()
+    tracker.close()
+    flow_tracker.stop_tracking()
+    flow_tracker.close()
+
+
+def test_detection_scale():
+    """
+    Tracking a high resolution frame at half scale should give
+    nearly the same result as at full scale
+    """
+    projection = np.loadtxt('data/calibration.txt', max_rows = 3) * 2.0
+    distortion = np.loadtxt('data/calibration.txt', skiprows = 3)
+    projection[2, 2] = 1.0
+    config = {'video source' : 'none',
+              'camera projection' : projection,
+              'camera distortion' : distortion,
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    scaled_tracker = ArUcoTracker(dict(config, **{'detection scale' : 0.5}))
+    scaled_tracker.start_tracking()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    capture.release()
+    image = cv2.resize(image, None, fx = 2, fy = 2,
+                       interpolation = cv2.INTER_CUBIC)
+
+    (_port_handles, _timestamps, _framenumbers,
+     tracking, quality) = tracker.get_frame(image)
+    (_port_handles, _timestamps, _framenumbers,
+     scaled_tracking, scaled_quality) = scaled_tracker.get_frame(image)
+    assert scaled_quality[0] == quality[0]
+    assert np.allclose(scaled_tracking[0][0:3, 3], tracking[0][0:3, 3],
+                       atol = 2.0)
+
+    with pytest.raises(ValueError):
+        ArUcoTracker(dict(config, **{'detection scale' : 2.0}))
+    tracker.stop_tracking()
+    tracker.close()
+    scaled_tracker.stop_tracking()
+    scaled_tracker.close()
+
+
+def test_detection_tiles():
+    """
+    Tracking with tiled detection should give the same results as
+    searching the whole frame
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    tiled_tracker = ArUcoTracker(dict(config, **{'detection tiles' : [2, 2],
+                                                 'tile overlap' : 150,
+                                                 'worker threads' : 2}))
+    tiled_tracker.start_tracking()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    for _frame in range(3):
+        _, image = capture.read()
+        (port_handles, _timestamps, _framenumbers,
+         tracking, quality) = tracker.get_frame(image)
+        (tiled_port_handles, _timestamps, _framenumbers,
+         tiled_tracking, tiled_quality) = tiled_tracker.get_frame(image)
+        assert sorted(port_handles) == sorted(tiled_port_handles)
+        assert quality[0] == tiled_quality[0]
+        assert np.allclose(tracking[0], tiled_tracking[0], atol = 1e-3)
+
+    capture.release()
+    tracker.stop_tracking()
+    tracker.close()
+    tiled_tracker.stop_tracking()
+    tiled_tracker.close()
+
+
+def test_worker_threads():
+    """
+    Detecting dictionaries and estimating poses on worker threads
+    should give the same results, in the same order, as doing it all
+    on one thread
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'single pass detection' : False,
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      },
+                      {
+                        'name' : 'tag_0',
+                        'filename' : 'data/tag_0.txt',
+                        'aruco dictionary' : 'DICT_4X4_50'
+                      },
+                      {
+                        'name' : 'pointer',
+                        'filename' : 'data/pointer.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    threaded_tracker = ArUcoTracker(dict(config, **{'worker threads' : 3}))
+    threaded_tracker.start_tracking()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    for _frame in range(3):
+        _, image = capture.read()
+        (port_handles, _timestamps, _framenumbers,
+         tracking, quality) = tracker.get_frame(image)
+        (threaded_port_handles, _timestamps, _framenumbers,
+         threaded_tracking, threaded_quality) = \
+                        threaded_tracker.get_frame(image)
+        assert port_handles == threaded_port_handles
+        assert quality == threaded_quality
+        assert np.array_equal(np.array(tracking),
+                              np.array(threaded_tracking), equal_nan = True)
+
+    capture.release()
+    tracker.stop_tracking()
+    tracker.close()
+    threaded_tracker.stop_tracking()
+    threaded_tracker.close()
+
+
+def test_motion_gate():
+    """
+    Tracking of unchanged frames should be reused, unless the motion
+    gate interval has passed
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'motion gate' : True,
+              'motion gate interval' : 3,
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    (port_handles, _timestamps, _framenumbers,
+     tracking, quality) = tracker.get_frame(image)
+    assert not tracker.frame_reused()
+
+    for frame in range(4):
+        (reused_port_handles, _timestamps, framenumbers,
+         reused_tracking, reused_quality) = tracker.get_frame(image)
+        assert tracker.frame_reused() == (frame != 2)
+        assert reused_port_handles == port_handles
+        assert reused_quality == quality
+        assert framenumbers[0] == frame + 1
+        assert np.allclose(reused_tracking[0], tracking[0])
+
+    arrays = tracker.get_frame_arrays(image)
+    assert arrays.reused
+
+    _, image = capture.read()
+    _, image = capture.read()
+    tracker.get_frame(image)
+    assert not tracker.frame_reused()
+
+    capture.release()
+    tracker.stop_tracking()
+    tracker.close()
+
+
+def test_max_corner_motion():
+    """
+    Rigid bodies with a max corner motion should not estimate
+    their pose again for an unchanged frame
+    """
+    config = {'video source' : 'none',
+              'calibration' : 'data/calibration.txt',
+              'rigid bodies' : [
+                      {
+                        'name' : 'reference',
+                        'filename' : 'data/reference.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL',
+                        'max corner motion' : 0.5
+                      },
+                      {
+                        'name' : 'pointer',
+                        'filename' : 'data/pointer.txt',
+                        'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'
+                      }]
+              }
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+
+    capture = cv2.VideoCapture('data/multipattern.avi')
+    _, image = capture.read()
+    (_port_handles, _timestamps, _framenumbers,
+     tracking, _quality) = tracker.get_frame(image)
+    for _frame in range(3):
+        (_port_handles, _timestamps, _framenumbers,
+         gated_tracking, _quality) = tracker.get_frame(image)
+        assert np.allclose(tracking[0], gated_tracking[0])
+
+    assert tracker.get_gate_counts() == {'reference' : (3, 1),
+                                         'pointer' : (0, 0)}
+    capture.release()
+    tracker.stop_tracking()
+    tracker.close()
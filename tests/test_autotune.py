@@ -0,0 +1,74 @@
+#  -*- coding: utf-8 -*-
+"""Tests for the detector parameter autotuner"""
+import json
+import pytest
+import numpy as np
+from sksurgeryarucotracker import autotune
+
+
+def test_read_frames():
+    """
+    Frames should be read up to max frames, and a bad video rejected
+    """
+    assert len(autotune.read_frames('data/output.avi', 3)) == 3
+    assert len(autotune.read_frames('data/output.avi')) == 10
+    with pytest.raises(OSError):
+        autotune.read_frames('data/not_a_video.avi')
+
+
+def test_autotune():
+    """
+    The accurate settings should find every baseline marker, and
+    reduced scale should lose some
+    """
+    config = {'aruco dictionary' : 'DICT_ARUCO_ORIGINAL'}
+    accurate = {'detector preset' : 'accurate'}
+    quarter_scale = {'detection scale' : 0.25}
+    frames = autotune.read_frames('data/multipattern.avi', 3)
+    results = autotune.autotune(frames, config, [accurate, quarter_scale])
+
+    assert len(results) == 2
+    assert results[0][0] == 1.0
+    assert results[1][0] < 1.0
+    for recall, mean_time, p99_time, settings in results:
+        assert 0.0 <= recall <= 1.0
+        assert 0.0 < mean_time <= p99_time
+        assert settings in [accurate, quarter_scale]
+
+    with pytest.raises(ValueError):
+        autotune.autotune([np.zeros((480, 640, 3), dtype = np.uint8)],
+                          config, [accurate])
+
+    assert len(autotune.default_search_space()) == 48
+
+
+def test_pareto_front():
+    """
+    Only results not beaten on every measure should be kept,
+    fastest first
+    """
+    results = [(1.0, 0.03, 0.04, 'a'), (0.9, 0.01, 0.02, 'b'),
+               (0.9, 0.02, 0.02, 'c'), (0.8, 0.01, 0.01, 'd'),
+               (1.0, 0.03, 0.04, 'e')]
+    front = autotune.pareto_front(results)
+    assert [result[3] for result in front] == ['d', 'b', 'a', 'e']
+
+
+def test_main(capsys, tmp_path):
+    """
+    The command line tool should print ready to use configurations
+    """
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({'video source' : 'none',
+                                       'aruco dictionary' :
+                                            'DICT_6X6_250'}))
+    autotune.main(['data/12markers.avi', '-c', str(config_file),
+                   '-n', '1'])
+    output = capsys.readouterr().out
+    blocks = [block for block in output.split('# recall ') if block]
+    assert blocks
+    for block in blocks:
+        config = json.loads(block[block.index('{'):])
+        assert config['video source'] == 'none'
+        assert 'detector parameters' in config
+        assert 'detection scale' in config
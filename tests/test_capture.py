@@ -0,0 +1,127 @@
+# coding=utf-8
+
+"""scikit-surgeryarucotracker capture tests"""
+
+from time import time
+import pytest
+import numpy as np
+import cv2
+from sksurgeryarucotracker.capture import ThreadedCapture, \
+                DrainingCapture, FramePool
+
+
+def test_threaded_capture():
+    """
+    The threaded capture should return frames until the source
+    is exhausted, and never return the same frame twice.
+    """
+    capture = ThreadedCapture()
+    assert capture.open('data/output.avi')
+    assert capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    assert capture.get(cv2.CAP_PROP_FRAME_WIDTH) == 640
+
+    frames_read = 0
+    success, frame = capture.read()
+    while success:
+        assert frame.shape == (480, 640, 3)
+        assert capture.get_grab_time() <= time()
+        frames_read += 1
+        success, frame = capture.read()
+
+    assert 0 < frames_read <= 10
+    assert frame is None
+    capture.release()
+
+
+def test_draining_capture():
+    """
+    Grabs from a video file never wait, so the draining capture should
+    discard max_drain frames before each frame it returns.
+    """
+    capture = DrainingCapture(max_drain = 2, min_wait = 1.0)
+    assert capture.read() == (False, None)
+    assert capture.get_grab_time() is None
+    assert capture.open('data/output.avi')
+    assert capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    assert capture.get(cv2.CAP_PROP_FRAME_WIDTH) == 640
+
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames_read = 0
+    last_grab_time = 0.0
+    success, frame = capture.read()
+    while success:
+        assert frame.shape == (480, 640, 3)
+        assert last_grab_time <= capture.get_grab_time() <= time()
+        last_grab_time = capture.get_grab_time()
+        frames_read += 1
+        success, frame = capture.read()
+
+    assert frames_read == frame_count // 3
+    assert capture.get_frames_drained() == 2 * frames_read + 1
+    capture.release()
+
+
+def test_draining_capture_waits():
+    """
+    With a zero minimum wait every grab counts as new, so no frames
+    are drained.
+    """
+    capture = DrainingCapture(min_wait = 0.0)
+    assert capture.open('data/output.avi')
+    frames_read = 0
+    while capture.read()[0]:
+        frames_read += 1
+    assert frames_read == int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    assert capture.get_frames_drained() == 0
+    capture.release()
+
+
+def test_threaded_capture_buffer():
+    """
+    The threaded capture should copy frames into a buffer of the right
+    shape, and return a new array otherwise.
+    """
+    capture = ThreadedCapture()
+    assert capture.open('data/output.avi')
+    buffer = np.zeros((480, 640, 3), dtype = np.uint8)
+    success, frame = capture.read(buffer)
+    assert success
+    assert frame is buffer
+    assert np.any(buffer)
+
+    success, frame = capture.read(np.zeros((10, 10, 3), dtype = np.uint8))
+    assert success
+    assert frame.shape == (480, 640, 3)
+    capture.release()
+
+
+def test_frame_pool():
+    """
+    The frame pool should reuse its buffers in turn, returning the
+    same frames as a plain read.
+    """
+    with pytest.raises(ValueError):
+        FramePool(0)
+
+    pool = FramePool(2)
+    capture = cv2.VideoCapture('data/output.avi')
+    reference = cv2.VideoCapture('data/output.avi')
+    frames = []
+    for _ in range(4):
+        success, frame = pool.read(capture)
+        assert success
+        assert np.array_equal(frame, reference.read()[1])
+        frames.append(frame)
+
+    assert frames[2] is frames[0]
+    assert frames[3] is frames[1]
+    assert frames[1] is not frames[0]
+
+    drain = DrainingCapture(max_drain = 0)
+    assert drain.open('data/output.avi')
+    first = pool.read(drain)[1]
+    pool.read(drain)
+    assert pool.read(drain)[1] is first
+    drain.release()
+    capture.release()
+    reference.release()
@@ -0,0 +1,70 @@
+# coding=utf-8
+
+"""Tests for tracking recorded video across worker processes"""
+
+import pytest
+import numpy as np
+from sksurgeryarucotracker.arucotracker import ArUcoTracker
+from sksurgeryarucotracker.offline import frame_ranges, process_video, \
+                _track_range
+
+
+def test_frame_ranges():
+    """
+    Frame ranges should cover every frame once, in order
+    """
+    assert frame_ranges(10, 3) == [(0, 3), (3, 7), (7, 10)]
+    assert frame_ranges(2, 4) == [(0, 1), (1, 2)]
+    assert frame_ranges(10, 1) == [(0, 10)]
+
+
+def test_process_video():
+    """
+    Tracking split across workers should match tracking every frame
+    with one tracker
+    """
+    tracker = ArUcoTracker({'video source' : 'data/output.avi'})
+    tracker.start_tracking()
+    expected = [tracker.get_frame() for _ in range(10)]
+    tracker.close()
+
+    for workers in [1, 3]:
+        result = process_video('data/output.avi', {}, workers = workers)
+        assert result['tool names'] == ['DICT_4X4_50:0']
+        assert np.array_equal(result['frame index'], np.arange(10))
+        assert np.array_equal(result['tool handle'], np.zeros(10))
+        assert result['tracking'].shape == (10, 4, 4)
+        for row, frame in enumerate(expected):
+            assert np.allclose(result['tracking'][row], frame[3][0])
+            assert result['quality'][row] == frame[4][0]
+
+    result = process_video('data/output.avi', {'use quaternions' : True,
+                                               'smoothing buffer' : 3},
+                           workers = 1)
+    assert result['tracking'].shape == (10, 4, 4)
+
+    with pytest.raises(ValueError):
+        process_video('data/output.avi', {}, workers = 0)
+    with pytest.raises(OSError):
+        process_video('data/no_such_video.avi', {})
+
+
+def test_track_range_seeks():
+    """
+    A range starting part way through a video should seek to its first
+    frame, rather than tracking from the start of the video
+    """
+    tracker = ArUcoTracker({'video source' : 'data/output.avi'})
+    tracker.start_tracking()
+    expected = [tracker.get_frame() for _ in range(10)]
+    tracker.close()
+    #frames must differ, or a range tracked from frame 0 would pass
+    assert not np.allclose(expected[0][3][0], expected[7][3][0])
+
+    frame_indices, port_handles, tracking, quality = \
+                    _track_range('data/output.avi', {}, 7, None)
+    assert frame_indices == [7, 8, 9]
+    assert port_handles == ['DICT_4X4_50:0'] * 3
+    for row, frame in enumerate(expected[7:]):
+        assert np.allclose(tracking[row], frame[3][0])
+        assert quality[row] == frame[4][0]
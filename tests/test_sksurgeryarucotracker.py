@@ -2,6 +2,7 @@
 
 """scikit-surgeryarucotracker tests"""
 
+from time import time
 import pytest
 import numpy as np
 from cv2 import VideoCapture
@@ -33,6 +34,169 @@ def test_on_video_with_single_tag():
     tracker.close()
 
 
+def test_threaded_capture_video():
+    """
+    connect track and close with single tag, reading frames on
+    a background thread
+    reqs: 03, 04 ,05
+    """
+    config = {'video source' : 'data/output.avi',
+              'threaded capture' : True}
+
+    tracker = ArUcoTracker(config)
+    assert tracker.has_capture()
+    tracker.start_tracking()
+    (port_handles, _timestamps, framenumbers,
+     _tracking, quality) = tracker.get_frame()
+    assert port_handles[0] == 'DICT_4X4_50:0'
+    assert framenumbers[0] == 0
+    assert quality[0] == 1.0
+
+    tracker.stop_tracking()
+    tracker.close()
+
+
+def test_draining_capture_video():
+    """
+    connect track and close with single tag, draining stale frames,
+    with the grab time as the timestamp
+    """
+    config = {'video source' : 'data/output.avi',
+              'drain stale frames' : True,
+              'max drained frames' : 0}
+
+    tracker = ArUcoTracker(config)
+    tracker.start_tracking()
+    before = time()
+    (port_handles, timestamps, _framenumbers,
+     _tracking, quality) = tracker.get_frame()
+    assert port_handles[0] == 'DICT_4X4_50:0'
+    assert quality[0] == 1.0
+    assert before <= timestamps[0] <= time()
+    tracker.stop_tracking()
+    tracker.close()
+
+    config['threaded capture'] = True
+    with pytest.raises(ValueError):
+        ArUcoTracker(config)
+
+
+def test_frame_buffers():
+    """
+    Reading into reused frame buffers should track the same as reading
+    into a new buffer each frame
+    """
+    results = []
+    for buffers in [1, 3]:
+        tracker = ArUcoTracker({'video source' : 'data/output.avi',
+                                'frame buffers' : buffers,
+                                'optical flow' : True})
+        tracker.start_tracking()
+        results.append([tracker.get_frame()[3] for _ in range(10)])
+        tracker.close()
+
+    for single, pooled in zip(*results):
+        assert np.allclose(single, pooled)
+
+    with pytest.raises(ValueError):
+        ArUcoTracker({'video source' : 'data/output.avi',
+                      'frame buffers' : 0})
+
+
+def test_quaternion_arrays():
+    """
+    With smoothing, get_frame_arrays should give 4x4 tracking matrices
+    whether or not use quaternions is set
+    """
+    results = []
+    for use_quaternions in [False, True]:
+        tracker = ArUcoTracker({'video source' : 'data/output.avi',
+                                'calibration' : 'data/calibration.txt',
+                                'smoothing buffer' : 3,
+                                'use quaternions' : use_quaternions})
+        tracker.start_tracking()
+        results.append([tracker.get_frame_arrays().tracking[0].copy()
+                        for _ in range(5)])
+        tracker.close()
+
+    for matrices, from_quaternions in zip(*results):
+        assert from_quaternions.shape == (4, 4)
+        assert np.allclose(matrices, from_quaternions, atol = 1e-6)
+
+
+def test_iter_frames_video():
+    """
+    iter_frames should track the chosen frames of the video source,
+    then release it
+    """
+    capture = VideoCapture('data/output.avi')
+    images = [capture.read()[1] for _ in range(10)]
+    capture.release()
+    image_tracker = ArUcoTracker({'video source' : 'none'})
+    image_tracker.start_tracking()
+
+    tracker = ArUcoTracker({'video source' : 'data/output.avi'})
+    tracker.start_tracking()
+    results = list(tracker.iter_frames(start = 1, stop = 8, step = 3))
+    assert [frame_index for frame_index, _ in results] == [1, 4, 7]
+    for frame_index, tracking in results:
+        assert tracking[0][0] == 'DICT_4X4_50:0'
+        assert np.allclose(tracking[3],
+                           image_tracker.get_frame(images[frame_index])[3])
+
+    with pytest.raises(ValueError):
+        tracker.get_frame()
+    tracker.close()
+
+    tracker = ArUcoTracker({'video source' : 'data/output.avi'})
+    tracker.start_tracking()
+    assert [frame_index for frame_index, _ in
+            tracker.iter_frames(step = 4)] == [0, 4, 8]
+    tracker.close()
+
+    #these capture modes drop frames, so the frame indices would be wrong
+    for capture_mode in ['threaded capture', 'drain stale frames']:
+        tracker = ArUcoTracker({'video source' : 'data/output.avi',
+                                capture_mode : True})
+        tracker.start_tracking()
+        with pytest.raises(ValueError):
+            next(tracker.iter_frames(start = 2, step = 3))
+        assert [frame_index for frame_index, _ in
+                tracker.iter_frames(images, start = 2, step = 3)] == [2, 5, 8]
+        tracker.close()
+
+
+def test_iter_frames_images():
+    """
+    iter_frames should pull images from an iterable only as it needs them
+    """
+    capture = VideoCapture('data/output.avi')
+    pulled = []
+
+    def images():
+        success, image = capture.read()
+        while success:
+            pulled.append(image)
+            yield image
+            success, image = capture.read()
+
+    tracker = ArUcoTracker({'video source' : 'none'})
+    tracker.start_tracking()
+    frames = tracker.iter_frames(images(), start = 2, step = 2)
+    frame_index, tracking = next(frames)
+    assert frame_index == 2
+    assert len(pulled) == 3
+    assert tracking[0][0] == 'DICT_4X4_50:0'
+    assert [frame_index for frame_index, _ in frames] == [4, 6, 8]
+    capture.release()
+
+    with pytest.raises(ValueError):
+        next(tracker.iter_frames())
+    with pytest.raises(ValueError):
+        next(tracker.iter_frames([], step = 0))
+    tracker.close()
+
+
 def test_no_video_single_tag():
     """
     raises a value error when no video and no image passed.